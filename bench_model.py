@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+"""
+Benchmark the PSMC thermal model on synthetic state schedules.
+
+Times twodof.calc_twodof_model, twodof.TwoDOF.calc_model and predict.predict
+for schedules from one week to five years long, for several model time steps
+``dt`` and output time spacings, and writes the results to a JSON file so
+that performance regressions can be tracked.  The twodof functions are timed
+on the ``dt`` grid and with ``exact=True`` (as used by the calibration), each
+with a cold and a warm twodof.eigsys_cache.
+
+Usage: python bench_model.py [--out bench_model.json] [--days 7,30,365,1826]
+"""
+import sys
+import json
+import time
+import timeit
+import platform
+import optparse
+
+import numpy as np
+import twodof
+import predict
+import characteristics
+
+# SIM-Z positions (steps) for HRC-S, HRC-I, ACIS-S and ACIS-I
+SIMZS = (-99616, -50504, 75624, 92904)
+
+def get_options():
+    parser = optparse.OptionParser()
+    parser.add_option("--out",
+                      default='bench_model.json',
+                      help="Output JSON file")
+    parser.add_option("--days",
+                      default='7,30,365,1826',
+                      help="Comma-separated schedule lengths (days)")
+    parser.add_option("--dts",
+                      default='32.8,328.0',
+                      help="Comma-separated model time steps (sec)")
+    parser.add_option("--dt-outs",
+                      default='32.8,328.0,3280.0',
+                      help="Comma-separated output time spacings (sec)")
+    parser.add_option("--repeat",
+                      type='int',
+                      default=3,
+                      help="Number of timing repeats (best is reported)")
+    parser.add_option("--seed",
+                      type='int',
+                      default=1,
+                      help="Random seed for synthetic schedules")
+    opt, args = parser.parse_args()
+    return opt, args
+
+def make_states(days, seed=1):
+    """Make a contiguous synthetic schedule of states covering ``days``.
+
+    Observations last 5 to 100 ksec at a pitch between 46 and 170 deg and are
+    separated by maneuvers of 0.5 to 2 ksec that keep the SIM-Z and power of
+    the preceding observation.  The SIM-Z position is drawn from the science
+    instrument positions and the power from the characteristics.psmc_power
+    table (HRC observations use the 0-FEP powers).
+
+    :param days: schedule length (days)
+    :param seed: random seed
+    :rtype: np recarray of states with tstart tstop power pitch simpos
+    """
+    rand = np.random.RandomState(seed)
+    hrc_powers = [x[3] for x in characteristics.psmc_power if x[0] == 0]
+    acis_powers = [x[3] for x in characteristics.psmc_power if x[0] >= 3]
+
+    tstop = days * 86400.
+    t = 0.
+    pitch = 90.
+    simz = SIMZS[2]
+    power = acis_powers[0]
+    rows = []
+    while t < tstop:
+        # Maneuver to the next target
+        dur = rand.uniform(500., 2000.)
+        next_pitch = rand.uniform(46., 170.)
+        rows.append((t, t + dur, power, (pitch + next_pitch) / 2., simz))
+        t += dur
+
+        # Observation
+        pitch = next_pitch
+        simz = SIMZS[rand.randint(len(SIMZS))]
+        power = rand.choice(hrc_powers if simz < 0 else acis_powers)
+        dur = rand.uniform(5000., 100000.)
+        rows.append((t, t + dur, power, pitch, simz))
+        t += dur
+
+    states = np.rec.fromrecords(rows, names=('tstart', 'tstop', 'power', 'pitch', 'simpos'))
+    states = states[states['tstart'] < tstop]
+    states[-1].tstop = tstop
+    return states
+
+def time_call(func, repeat, setup=None):
+    """Call ``func`` ``repeat`` times and return the list of wall clock times.
+    If given, ``setup`` is called (untimed) before each call of ``func``."""
+    times = []
+    for i in range(repeat):
+        if setup is not None:
+            setup()
+        t0 = timeit.default_timer()
+        func()
+        times.append(timeit.default_timer() - t0)
+    return times
+
+def run_benchmarks(opt):
+    par = characteristics.model_par
+    pin0, dea0 = 35., 25.
+    results = []
+
+    def add_result(name, states, days, dt, dt_out, n_out, func, exact=False, cache=None):
+        # cache='cold' clears the eigensystem cache before each timed call,
+        # cache='warm' fills it with one untimed call first
+        setup = None
+        if cache == 'cold':
+            setup = twodof.eigsys_cache.clear
+        elif cache == 'warm':
+            func()
+        times = time_call(func, opt.repeat, setup)
+        result = dict(func=name, days=days, n_states=len(states), dt=dt,
+                      dt_out=dt_out, n_out=n_out, exact=exact, cache=cache,
+                      best=min(times), mean=float(np.mean(times)), times=times)
+        print('%-24s days=%-5d dt=%-6.1f dt_out=%-7s n_out=%-8d exact=%-5s cache=%-5s '
+              'best=%.4f s' % (name, days, dt, dt_out, n_out, exact, cache, result['best']))
+        sys.stdout.flush()
+        results.append(result)
+
+    for days in [int(x) for x in opt.days.split(',')]:
+        states = make_states(days, opt.seed)
+        for dt in [float(x) for x in opt.dts.split(',')]:
+            for dt_out in [float(x) for x in opt.dt_outs.split(',')]:
+                out_times = np.arange(states[0].tstart, states[-1].tstop, dt_out)
+
+                for exact in (False, True):
+                    for cache in ('cold', 'warm'):
+                        add_result('calc_twodof_model', states, days, dt, dt_out,
+                                   len(out_times),
+                                   lambda: twodof.calc_twodof_model(states, pin0, dea0,
+                                                                    out_times, par, dt=dt,
+                                                                    exact=exact),
+                                   exact, cache)
+
+                        # A new TwoDOF for each call so its per-instance results
+                        # cache never hits (twodof.eigsys_cache is set by ``cache``)
+                        add_result('TwoDOF.calc_model', states, days, dt, dt_out,
+                                   len(out_times),
+                                   lambda: twodof.TwoDOF(states, pin0, dea0, dt=dt,
+                                                         exact=exact).calc_model(
+                                       out_times, par, '1pdeaat'),
+                                   exact, cache)
+
+            # predict.predict chooses its own output times from dt
+            n_out = int(np.sum(((states['tstop'] - states['tstart']) / dt).astype(int) + 2))
+            add_result('predict.predict', states, days, dt, None, n_out,
+                       lambda: predict.predict(states, pin0, dea0, dt=dt,
+                                               tstartcol='tstart', tstopcol='tstop'))
+
+    return results
+
+def main(opt):
+    results = run_benchmarks(opt)
+    out = dict(date=time.strftime('%Y-%m-%dT%H:%M:%S'),
+               python=platform.python_version(),
+               numpy=np.__version__,
+               platform=platform.platform(),
+               characteristics_version=characteristics.VERSION,
+               repeat=opt.repeat,
+               seed=opt.seed,
+               results=results)
+    with open(opt.out, 'w') as f:
+        json.dump(out, f, indent=2)
+    print('Wrote %d results to %s' % (len(results), opt.out))
+
+if __name__ == '__main__':
+    opt, args = get_options()
+    main(opt)
@@ -0,0 +1,117 @@
+"""
+Benchmark predict.predict and predict.predict_nonvec against the original
+per-state twomass.calcT_vec and per-sample twomass.calcT loops, and check
+that the results agree.  predict_nonvec is also run on a schedule that
+includes states shorter than 2 * dt, where it differs from the original loop
+by design (see the predict.predict_nonvec docstring).
+
+Usage: python bench_predict.py [n_states]
+"""
+import sys
+import time
+import numpy as np
+import twomass
+import predict
+from twomass import DegCtoDegK as CtoK, DegKtoDegC as KtoC
+
+def make_states(n_states, seed=1, short_frac=0., dt=32.8):
+    """Make a contiguous schedule of ``n_states`` random states.  A fraction
+    ``short_frac`` of them are shorter than ``2 * dt``."""
+    rand = np.random.RandomState(seed)
+    durs = np.where(rand.uniform(size=n_states) < short_frac,
+                    rand.uniform(1., 2 * dt, n_states),
+                    rand.uniform(2000., 100000., n_states))
+    tstops = np.cumsum(durs)
+    tstarts = np.concatenate([[0.], tstops[:-1]])
+    return np.rec.fromarrays([tstarts, tstops,
+                              rand.uniform(20., 120., n_states),
+                              rand.uniform(50., 170., n_states),
+                              rand.choice([-99616., -50000., 75624., 92904.], n_states)],
+                             names=['time_start', 'time_stop', 'power', 'pitch', 'simpos'])
+
+def predict_calcT_vec(states, pin0, dea0, dt=32.8):
+    """Original predict.predict: one twomass.calcT_vec call per state."""
+    predT = None
+    predvals = []
+    for state in states:
+        t0 = state['time_start']
+        T0 = twomass.Ext_T0(state['pitch'], state['simpos'])
+        if predT is None:
+            Ti = np.array([[pin0],
+                           [dea0]]) + CtoK
+        else:
+            Ti = predT[:, -1].reshape(2,1)
+        model = twomass.TwoMass(state['power'], T0, Ti)
+        n_t = int((state['time_stop'] - state['time_start']) / dt)
+        t = np.linspace(state['time_start'], state['time_stop'], n_t+2)
+        predT = model.calcT_vec(t - t0)
+        onest = np.ones_like(t)
+        predvals.append(np.array([t,
+                                  predT[0,:] + KtoC,
+                                  predT[1,:] + KtoC,
+                                  state['power'] * onest,
+                                  state['pitch'] * onest,
+                                  state['simpos'] * onest]))
+
+    predvals = np.hstack(predvals)
+    return np.rec.fromarrays(predvals,
+                             formats=['f8', 'f4', 'f4', 'f4', 'f4', 'f4'],
+                             names=['time', '1pin1at', '1pdeaat', 'power', 'pitch', 'simpos'])
+
+def predict_calcT(states, pin0, dea0, dt=32.8):
+    """Original predict.predict_nonvec: one twomass.calcT call per sample."""
+    predT = None
+    predvals = []
+    for state in states:
+        t0 = state['time_start']
+        T0 = twomass.Ext_T0(state['pitch'], state['simpos'])
+        if predT is None:
+            Ti = np.array([[pin0],
+                           [dea0]]) + CtoK
+        else:
+            # Temperatures of the last sample, not of the state end
+            Ti = predT.reshape(2, 1)
+        model = twomass.TwoMass(state['power'], T0, Ti)
+        n_ts = int((state['time_stop'] - state['time_start']) / dt)
+        for t in np.linspace(state['time_start'], state['time_stop'], n_ts):
+            predT = model.calcT(t - t0)
+            predvals.append((t, predT[0].tolist() + KtoC, predT[1].tolist() + KtoC,
+                             state['power'], state['pitch'], state['simpos']))
+
+    return np.rec.fromrecords(predvals,
+                              formats=['f8', 'f4', 'f4', 'f4', 'f4', 'f4'],
+                              names=['time', '1pin1at', '1pdeaat', 'power', 'pitch', 'simpos'])
+
+def run(func, *args):
+    t0 = time.time()
+    out = func(*args)
+    return out, time.time() - t0
+
+def report(name, new, t_new, old, t_old):
+    diff = max(np.max(np.abs(new[x] - old[x])) for x in ('1pin1at', '1pdeaat'))
+    print('%-16s n=%-9d old=%8.3f s  new=%8.3f s  speedup=%6.1f  max|dT|=%.2e C  '
+          'max|dt|=%.2e s'
+          % (name, len(new), t_old, t_new, t_old / t_new, diff,
+             np.max(np.abs(new['time'] - old['time']))))
+
+if __name__ == '__main__':
+    n_states = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    pin0, dea0 = 30., 40.
+
+    states = make_states(n_states)
+    old, t_old = run(predict_calcT_vec, states, pin0, dea0)
+    new, t_new = run(predict.predict, states, pin0, dea0)
+    report('predict', new, t_new, old, t_old)
+
+    # The per-sample calcT loop is very slow so use fewer states
+    states = make_states(max(n_states // 10, 1))
+    old, t_old = run(predict_calcT, states, pin0, dea0)
+    new, t_new = run(predict.predict_nonvec, states, pin0, dea0)
+    report('predict_nonvec', new, t_new, old, t_old)
+
+    # With states shorter than 2 * dt the original loop loses the temperature
+    # change over those states so the results differ
+    states = make_states(max(n_states // 10, 1), short_frac=0.25)
+    old, t_old = run(predict_calcT, states, pin0, dea0)
+    new, t_new = run(predict.predict_nonvec, states, pin0, dea0)
+    report('nonvec (short)', new, t_new, old, t_old)
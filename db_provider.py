@@ -0,0 +1,113 @@
+"""
+Shared, lazily connected database handles for the psmc modules.
+
+``get_db()`` returns a ``DBProvider`` for a given set of ``Ska.DBI.DBI``
+connection arguments.  Providers are pooled by connection arguments so
+repeated calls within one process (e.g. the two ``get_tlm_states`` calls in a
+calibration, or a batch of ``psmc_check`` runs) share one connection.  The
+connection is only made on first use, is checked with a trivial query before
+reuse after ``HEALTH_CHECK_INTERVAL`` seconds, and is remade if the check
+fails or the process has forked.
+
+A ``DBProvider`` passes attribute access through to the underlying
+``Ska.DBI.DBI`` object so it can be used anywhere a database handle is
+expected.  ``set_standin()`` makes all subsequent Sybase requests use a local
+SQLite database with the same tables instead.
+"""
+
+import os
+import time
+import logging
+
+import Ska.DBI
+
+# Seconds after which an idle connection is checked before reuse
+HEALTH_CHECK_INTERVAL = 60.0
+
+logger = logging.getLogger('psmc_check.db_provider')
+
+# Pooled providers keyed by connection arguments
+providers = {}
+
+# SQLite file to use in place of Sybase (None => use Sybase)
+standin = dict(server=None)
+
+class DBProvider(object):
+    """Lazily connected, health checked ``Ska.DBI.DBI`` handle.
+
+    :param connect_kwargs: keyword arguments for ``Ska.DBI.DBI``
+    """
+    def __init__(self, **connect_kwargs):
+        self.connect_kwargs = connect_kwargs
+        self._db = None
+        self.pid = None
+        self.last_used = 0.0
+
+    def connect(self):
+        """Make a new connection, closing any existing one."""
+        self.close()
+        logger.info('Connecting to %s database %s'
+                    % (self.connect_kwargs.get('dbi'), self.connect_kwargs.get('server')))
+        self._db = Ska.DBI.DBI(**self.connect_kwargs)
+        self.pid = os.getpid()
+        self.last_used = time.time()
+
+    def close(self):
+        """Close the connection (a new one is made on next use)."""
+        if self._db is not None:
+            # A connection inherited from a parent process is not ours to close
+            if self.pid == os.getpid():
+                try:
+                    self._db.conn.close()
+                except Exception:
+                    pass
+            self._db = None
+
+    def is_healthy(self):
+        """Return True if the connection answers a trivial query."""
+        try:
+            self._db.fetchone('SELECT 1 AS ok')
+        except Exception, msg:
+            logger.warning('Database connection check failed: %s' % msg)
+            return False
+        return True
+
+    @property
+    def db(self):
+        """Connected ``Ska.DBI.DBI`` object, (re)connecting as needed."""
+        if self._db is None or self.pid != os.getpid():
+            self.connect()
+        elif (time.time() - self.last_used > HEALTH_CHECK_INTERVAL
+              and not self.is_healthy()):
+            self.connect()
+        self.last_used = time.time()
+        return self._db
+
+    def __getattr__(self, attr):
+        if attr.startswith('_'):
+            raise AttributeError(attr)
+        return getattr(self.db, attr)
+
+def set_standin(server):
+    """Use the SQLite database file ``server`` for all subsequent Sybase
+    requests from ``get_db()`` (None => use Sybase)."""
+    standin['server'] = server
+
+def get_db(**connect_kwargs):
+    """Return the pooled ``DBProvider`` for ``Ska.DBI.DBI`` connection
+    arguments ``connect_kwargs`` (e.g. dbi='sybase', server='sybase',
+    user='aca_read', database='aca').
+
+    :rtype: DBProvider
+    """
+    if connect_kwargs.get('dbi') == 'sybase' and standin['server']:
+        connect_kwargs = dict(dbi='sqlite', server=standin['server'])
+    key = tuple(sorted(connect_kwargs.items()))
+    if key not in providers:
+        providers[key] = DBProvider(**connect_kwargs)
+    return providers[key]
+
+def close_all():
+    """Close all pooled connections."""
+    for provider in providers.values():
+        provider.close()
@@ -50,6 +50,16 @@ def get_options():
 #    outdir='test',)
 
 
+def read_py_table(py_dir, name):
+    """Read the psmc_check output table ``name`` (e.g. 'temperatures') from
+    ``py_dir``.  The binary <name>.npy file is memory-mapped if present,
+    otherwise the <name>.dat text file is parsed (older psmc_check output).
+    """
+    npy_file = os.path.join(py_dir, name + '.npy')
+    if os.path.exists(npy_file):
+        return np.load(npy_file, mmap_mode='r').view(np.recarray)
+    return Ska.Table.read_ascii_table(os.path.join(py_dir, name + '.dat'))
+
 def rst_to_html(opt):
     """Run rst2html.py to render index.rst as HTML
     (borrowed from psmc_check, proc stuff cut out )
@@ -108,10 +118,11 @@ def main(opt):
         os.mkdir(opt.outdir)
     temp_file = 'temperatures.dat'
     state_file = 'states.dat'
-    # read the temperatures from the ascii files from each method
-    py_temps = Ska.Table.read_ascii_table(os.path.join(opt.py_dir, temp_file))
+    # read the temperatures from the psmc_check binary (or ascii) files and
+    # the matlab ascii files
+    py_temps = read_py_table(opt.py_dir, 'temperatures')
     mat_temps = Ska.Table.read_ascii_table(os.path.join(opt.mat_dir, temp_file))
-    py_states = Ska.Table.read_ascii_table(os.path.join(opt.py_dir, state_file))
+    py_states = read_py_table(opt.py_dir, 'states')
     mat_states = Ska.Table.read_ascii_table(os.path.join(opt.mat_dir, state_file))
     # use the time range from the matlab processing for comparisons
     range_py = py_temps[( py_temps['date'] >= mat_temps[0]['Time']) 
@@ -3,6 +3,7 @@
 """Overplot the residuals for two runs of psmc_check.py for regression test purposes."""
 
 import os
+import sys
 import numpy
 import matplotlib.pyplot as plt
 import pickle
@@ -18,12 +19,23 @@ def get_options():
 
     return opt, args
 
+def get_resids(dirname, msid='1pdeaat'):
+    """Return the data - model residuals for ``msid`` from the psmc_check
+    output in ``dirname``.  The binary validation_data.npy file is
+    memory-mapped so only the residual column is read, otherwise the whole
+    validation_data.pkl pickle (older psmc_check output) is loaded."""
+    npy_file = os.path.join(dirname, 'validation_data.npy')
+    if os.path.exists(npy_file):
+        return numpy.load(npy_file, mmap_mode='r')['resid_' + msid]
+    dat = pickle.load(open(os.path.join(dirname, 'validation_data.pkl')))
+    return dat['tlm'][msid] - dat['pred'][msid]
+
 opt, args = get_options()
 dir1 = args[0]
 dir2 = args[1]
 
-dat1 = pickle.load(open(os.path.join(dir1, 'validation_data.pkl')))
-dat2 = pickle.load(open(os.path.join(dir2, 'validation_data.pkl')))
+resid1 = get_resids(dir1)
+resid2 = get_resids(dir2)
 
 plt.rc("axes", labelsize=10, titlesize=10)
 plt.rc("xtick", labelsize=10)
@@ -35,16 +47,16 @@ bins1 = numpy.arange(-10, 10, 0.4)
 bins2 = bins1 + 0.2
 plt.figure(figsize=(3.5,2.5))
 plt.clf()
-plt.hist(dat1['tlm']['1pdeaat'] - dat1['pred']['1pdeaat'], bins=bins1, facecolor='r')
-plt.hist(dat2['tlm']['1pdeaat'] - dat2['pred']['1pdeaat'], bins=bins2, facecolor='b', alpha=0.7)
+plt.hist(resid1, bins=bins1, facecolor='r')
+plt.hist(resid2, bins=bins2, facecolor='b', alpha=0.7)
 plt.title('Residual distribution (old=red new=blue)')
 plt.xlabel('Data - model (degC)')
 plt.subplots_adjust(bottom=0.17, top=0.84, left=0.17)
 plt.savefig('hist_compare_lin.png')
 
 plt.clf()
-plt.hist(dat1['tlm']['1pdeaat'] - dat1['pred']['1pdeaat'], bins=bins1, facecolor='r', log=True)
-plt.hist(dat2['tlm']['1pdeaat'] - dat2['pred']['1pdeaat'], bins=bins2, facecolor='b', alpha=0.7, log=True)
+plt.hist(resid1, bins=bins1, facecolor='r', log=True)
+plt.hist(resid2, bins=bins2, facecolor='b', alpha=0.7, log=True)
 plt.title('Residual distribution (old=red new=blue)')
 plt.xlabel('Data - model (degC)')
 plt.subplots_adjust(bottom=0.17, top=0.84)
@@ -1,5 +1,6 @@
 import numpy as np
 import twomass
+import twodof
 from twomass import DegCtoDegK as CtoK, DegKtoDegC as KtoC
 
 def state_diff(c1, c2):
@@ -23,6 +24,76 @@ def Pp(nccd):
     """
     return (128.1-56.9) * (nccd - 1) / (6-1) + 56.9
 
+PRED_DTYPE = [('time', 'f8'), ('1pin1at', 'f4'), ('1pdeaat', 'f4'),
+              ('power', 'f4'), ('pitch', 'f4'), ('simpos', 'f4')]
+
+def calc_state_coeffs(states, pin0, dea0, tstartcol='time_start', tstopcol='time_stop'):
+    """Calculate the closed-form solution coefficients of the twomass model for
+    all ``states`` at once.  The result has the same form as
+    twodof.calc_state_coeffs() and can be evaluated with
+    twodof.eval_state_coeffs().
+
+    @param states: numpy recarray of states (must be contiguous)
+    @param pin0: initial value (degC) of 1pin1at at states[0][tstartcol]
+    @param dea0: initial value (degC) of 1pdeaat at states[0][tstartcol]
+
+    @return: dict of coefficient arrays (tstart, tstop, eigvals, T_ss, amps, T_start)
+    """
+    tstart = np.array([x[tstartcol] for x in states], dtype=float)
+    tstop = np.array([x[tstopcol] for x in states], dtype=float)
+    power = np.array([x['power'] for x in states], dtype=float)
+    T0s = np.array([twomass.Ext_T0(x['pitch'], x['simpos']).degK for x in states])
+
+    n_states = len(tstart)
+    eigvals = np.tile(twomass.eigvals, (n_states, 1))
+    eigvecs = np.tile(twomass.eigvecs, (n_states, 1, 1))
+    eigvecinvs = np.tile(twomass.eigvecinvs, (n_states, 1, 1))
+    heat = np.column_stack([twomass.U01 * T0s / twomass.C1,
+                            power / twomass.C2])
+
+    y_ss, T_ss, A, b = twodof.calc_state_maps(eigvals, eigvecs, eigvecinvs, heat,
+                                              (tstop - tstart) / 1000.)
+    T_start = twodof.propagate_states(A, b, np.array([pin0, dea0]) + CtoK)
+
+    y_start = np.sum(eigvecinvs * T_start[..., np.newaxis, :], axis=-1)
+    amps = eigvecs * (y_start - y_ss)[..., np.newaxis, :]
+
+    return dict(tstart=tstart, tstop=tstop, eigvals=eigvals,
+                T_ss=T_ss, amps=amps, T_start=T_start)
+
+def get_times(tstart, tstop, n_ts):
+    """Make the concatenated times ``np.linspace(tstart[i], tstop[i], n_ts[i])``
+    for all states.
+
+    @return: times, idx (state index for each time)
+    """
+    idx = np.repeat(np.arange(len(n_ts)), n_ts)
+    i0s = np.cumsum(n_ts) - n_ts
+    steps = (tstop - tstart) / np.maximum(n_ts - 1, 1)
+    times = tstart[idx] + (np.arange(len(idx)) - i0s[idx]) * steps[idx]
+    ok = n_ts > 1
+    times[(i0s + n_ts - 1)[ok]] = tstop[ok]
+
+    return times, idx
+
+def calc_predict(states, coeffs, n_ts):
+    """Evaluate the model coefficients ``coeffs`` on ``n_ts`` evenly spaced
+    times in each state and fill the output recarray in one pass.
+
+    @return: recarray with cols time, 1pin1at, 1pdeaat, power, pitch, and simpos
+    """
+    times, idx = get_times(coeffs['tstart'], coeffs['tstop'], n_ts)
+    predT = twodof.eval_state_coeffs(coeffs, times, idx)
+
+    out = np.recarray(len(times), dtype=PRED_DTYPE)
+    out['time'] = times
+    out['1pin1at'] = predT[0] + KtoC
+    out['1pdeaat'] = predT[1] + KtoC
+    for col in ('power', 'pitch', 'simpos'):
+        out[col] = np.array([x[col] for x in states], dtype=float).take(idx)
+
+    return out
+
 def predict(states, pin0, dea0, dt=32.8, tstartcol='time_start', tstopcol='time_stop'):
     """Predict the PSMC temperatures 1pdeaat and 1pin1at given the list of
     configuration C{states} and initial temperatures C{dea_T0} and C{pin_T0}.
@@ -30,51 +101,39 @@ def predict(states, pin0, dea0, dt=32.8, tstartcol='time_start', tstopcol='time_
     The states recarray must include the following columns::
       tstart  tstop  power  pitch  simpos
 
+    Each state is sampled at C{n_t + 2} evenly spaced times including both
+    state boundaries, where C{n_t = int((tstop - tstart) / dt)}.  All states
+    are evaluated in one vectorized pass from the closed-form solution.
+
     @param states: numpy recarray of states (must be contiguous)
     @param pin0: initial value (degC) of 1pin1at at states[0]['tstart']
     @param dea0: initial value (degC) of 1pdeaat at states[0]['tstart']
     @param dt: approximate time spacing of output values (secs)
+    @param tstartcol: name of state start time column
+    @param tstopcol: name of state stop time column
 
     @return: recarray with cols time, 1pin1at, 1pdeaat, power, pitch, and simpos
     """
-    
-    predT = None
-    predvals = []
-
-    for state in states:
-        t0 = state[tstartcol]
-        T0 = twomass.Ext_T0(state['pitch'], state['simpos'])
-        if predT is None:
-            Ti = np.array([[pin0],
-                           [dea0]]) + CtoK
-        else:
-            Ti = predT[:, -1].reshape(2,1)
-
-        model = twomass.TwoMass(state['power'], T0, Ti)
-
-        # Make array of times. 
-        n_t = int((state[tstopcol] - state[tstartcol]) / dt)
-        t = np.linspace(state[tstartcol], state[tstopcol], n_t+2)
-
-        # Calculated predicted temperatures for this state
-        predT = model.calcT_vec(t - t0)
-        onest = np.ones_like(t)
-        predvals.append(np.array([t,
-                                  predT[0,:] + KtoC,
-                                  predT[1,:] + KtoC,
-                                  state['power'] * onest,
-                                  state['pitch'] * onest,
-                                  state['simpos'] * onest]))
-
-    predvals = np.hstack(predvals)
-    return np.rec.fromarrays(predvals,
-                             formats=['f8', 'f4', 'f4', 'f4', 'f4', 'f4'],
-                             names=['time', '1pin1at', '1pdeaat', 'power', 'pitch', 'simpos'])
-
-def predict_nonvec(states, pin0, dea0, dt=32.8):
+    coeffs = calc_state_coeffs(states, pin0, dea0, tstartcol, tstopcol)
+    n_ts = ((coeffs['tstop'] - coeffs['tstart']) / dt).astype(int) + 2
+
+    return calc_predict(states, coeffs, n_ts)
+
+def predict_nonvec(states, pin0, dea0, dt=32.8, tstartcol='time_start', tstopcol='time_stop'):
     """Predict the PSMC temperatures 1pdeaat and 1pin1at given the list of
     configuration C{states} and initial temperatures C{dea_T0} and C{pin_T0}.
-    Use the non-vectorized twomass.calcT() routine to do the calculation.
+
+    This gives the output times of the original per-sample twomass.calcT()
+    loop (C{int((tstop - tstart) / dt)} evenly spaced times in each state) but
+    uses the same vectorized calculation as predict().
+
+    Note the intentional change for states shorter than C{2 * dt}: the node
+    temperatures are now always propagated to the end of each state.  The
+    original loop carried the temperatures of the last output sample into the
+    next state, which is the state start for a state with one sample (or the
+    previous state's last sample for a state with none), so the heating or
+    cooling during such short states was lost.  For all other states the
+    results are the same.
 
     The states recarray must include the following columns::
       tstart  tstop  power  pitch  simpos
@@ -83,31 +142,12 @@ def predict_nonvec(states, pin0, dea0, dt=32.8):
     @param pin0: initial value (degC) of 1pin1at at states[0][tstartcol]
     @param dea0: initial value (degC) of 1pdeaat at states[0][tstartcol]
     @param dt: approximate time spacing of output values (secs)
+    @param tstartcol: name of state start time column
+    @param tstopcol: name of state stop time column
 
     @return: recarray with cols time, 1pin1at, 1pdeaat, power, pitch, and simpos
     """
-    
-    predT = None
-    predstates = []
-
-    for state in states:
-        t0 = state[tstartcol]
-        T0 = twomass.Ext_T0(state['pitch'], state['simpos'])
-        if predT is None:
-            Ti = np.array([[pin0],
-                           [dea0]]) + CtoK
-        else:
-            Ti = predT
-
-        model = twomass.TwoMass(state['power'], T0, Ti)
-
-        n_ts = int((state[tstopcol] - state[tstartcol]) / dt)
-        for t in np.linspace(state[tstartcol], state[tstopcol], n_ts):
-            predT = model.calcT(t - t0)
-            predstates.append((t, predT[0,0].tolist() + KtoC, predT[1,0].tolist() + KtoC,
-                              state['power'], state['pitch'], state['simpos']))
-
-    return np.rec.fromrecords(predstates,
-                              formats=['f8', 'f4', 'f4', 'f4', 'f4', 'f4'],
-                              names=['time', '1pin1at', '1pdeaat', 'power', 'pitch', 'simpos'])
+    coeffs = calc_state_coeffs(states, pin0, dea0, tstartcol, tstopcol)
+    n_ts = ((coeffs['tstop'] - coeffs['tstart']) / dt).astype(int)
 
+    return calc_predict(states, coeffs, n_ts)
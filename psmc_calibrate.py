@@ -7,15 +7,18 @@ Calibrate PSMC model coefficients using telemetry from specified time range.
 import sys
 import time
 import optparse
+import multiprocessing
 
 import matplotlib.pyplot as plt
 import Chandra.Time
 import numpy as np
 import twodof
 import Ska.Table
-import Ska.DBI
 import psmc_check
 import characteristics
+import telem_cache
+import states_mirror
+import db_provider
 
 from sherpa.astro.ui import *
 from sherpa.stats import *
@@ -23,110 +26,131 @@ from sherpa.optmethods import *
 from sherpa.estmethods import *
 
 
-PARNAMES = sorted(characteristics.model_par)
+PARNAMES = twodof.PARNAMES
 
-def psmc_temps_model(msid, tlm, states):
-    """Return a sherpa model to evaluate PSMC temperatures at given times."""
-    cache = dict(pars=None)
+def psmc_temps_model(msid, tlm, states, cache, pool=None, n_core=0):
+    """Return a sherpa model to evaluate PSMC temperatures at given times.
 
+    The models for 1pdeaat and 1pin1at share ``cache`` (a dict holding the
+    last parameter values and times with the resulting temperatures of both
+    MSIDs) so the model is only calculated once for each parameter set.  If
+    ``pool`` is given the model is evaluated with
+    twodof.calc_twodof_model_parallel in ``n_core`` chunks on that pool.  The
+    node temperatures at the boundaries between the chunks of states are
+    propagated exactly from the initial telemetry values, so the result is
+    the same as for the serial calculation.
+    """
     def psmc_temp(pars, times):
-        par = dict(zip(PARNAMES, pars))
-        if pars != cache['pars']:
-            cache['1pin1at'], cache['1pdeaat'] = \
-                twodof.calc_twodof_model(states,
-                                         tlm[0]['1pin1at'], tlm[0]['1pdeaat'],
-                                         times, dt=300.0,
-                                         par=par)
-            cache['pars'] = pars
-            print pars
-        return cache[msid]
-
-    return psmc_temp
-
-def psmc_temps_model_multi(msid, tlm, states, n_core):
-    """Return a sherpa model to evaluate PSMC temperatures at given times."""
-    from multiprocessing import Process, Pipe
-    core_tstarts = np.linspace(tlm[0].date, tlm[-1].date, n_core+1)
-
-    # Divide the states up into n_core pieces.  Force the start/end values
-    # to be as expected.
-    s_idxs = np.searchsorted(states['tstop'], core_tstarts)
-    s_idxs[0] = 0
-    s_idxs[-1] = len(states)
-    core_states = [states[s_idxs[i]:s_idxs[i+1]] for i in range(n_core)]
-    core_tstarts = [core_states[i][0].tstart for i in range(n_core)]
-
-    # Divide the times into the same intervals as the core_states and again
-    # force the start/end values to be correct.
-    t_idxs = np.searchsorted(tlm.date, core_tstarts)
-    t_idxs[0] = 0
-    t_idxs = np.append(t_idxs, [len(tlm.date)])
-    core_times = [tlm.date[t_idxs[i]:t_idxs[i+1]] for i in range(n_core)]
-
-    import os
-    def twodof_multi(conn):
-        while True:
-            par = conn.recv()
-            pin, dea = twodof.calc_twodof_model(states=core_states[i],
-                                                T_pin0=tlm['1pin1at'][t_idxs[i]],
-                                                T_dea0=tlm['1pdeaat'][t_idxs[i]],
-                                                times=core_times[i],
-                                                dt=300.0,
-                                                par=par)
-            conn.send((pin, dea))
-
-    conns = []
-    ps = []
-    for i in range(n_core):
-        parent_conn, child_conn = Pipe()
-        p = Process(target=twodof_multi,
-                    args=(child_conn,))
-        p.start()
-        ps.append(p)
-        conns.append(parent_conn)
-
-    cache = dict(pars=None)
-    def psmc_temp(pars, times):
-        """Evalate the twodof model for ``pars`` at ``times``.
-
-        For efficiency the supplied ``times`` is ignored since it must be the
-        same as tlm.date used above which was used to create core_times.
-        """
-        par = dict(zip(PARNAMES, pars))
-        if pars != cache['pars']:
-            pins = []
-            deas = []
-            # Start the cores in parallel by supplying par values
-            for i in range(n_core):
-                conns[i].send(par)
-
-            # Get the return values
-            for i in range(n_core):
-                pin, dea = conns[i].recv()
-                pins.append(pin)
-                deas.append(dea)
-                
-            cache['1pdeaat'] = np.hstack(deas)
-            cache['1pin1at'] = np.hstack(pins)
-            cache['pars'] = pars
+        key = (tuple(pars), twodof.get_times_key(times))
+        if key != cache.get('key'):
+            par = dict(zip(PARNAMES, pars))
+            if pool is None:
+                cache['1pin1at'], cache['1pdeaat'] = \
+                    twodof.calc_twodof_model(states,
+                                             tlm[0]['1pin1at'], tlm[0]['1pdeaat'],
+                                             times, exact=True,
+                                             par=par)
+            else:
+                cache['1pin1at'], cache['1pdeaat'] = \
+                    twodof.calc_twodof_model_parallel(states,
+                                                      tlm[0]['1pin1at'], tlm[0]['1pdeaat'],
+                                                      times, exact=True, par=par,
+                                                      n_chunk=n_core, pool=pool)
+            cache['key'] = key
             print '.',
             sys.stdout.flush()
-            # print msid, pars
 
         return cache[msid]
 
     return psmc_temp
 
-def get_tlm_states(datestop='2009-06-01T00:00:00', ndays=180):
+def fit_jacobian(tlm, states, model_par, thawed, msids=('1pdeaat', '1pin1at')):
+    """Fit the ``thawed`` model parameters to ``tlm`` for ``msids`` using the
+    Levenberg-Marquardt method with the analytic model Jacobian from
+    twodof.calc_twodof_jacobian.  Residuals are evaluated with a plain
+    (real) model calculation and the Jacobian, with derivatives for the
+    ``thawed`` parameters only, just when ``leastsq`` asks for it.
+
+    :param tlm: telemetry recarray
+    :param states: commanded states
+    :param model_par: starting model parameters dictionary
+    :param thawed: list of parameter names to fit
+    :param msids: MSIDs included in the fit statistic
+
+    :returns: model parameters dictionary with fitted values (or the starting
+              values if the fit fails)
+    """
+    from scipy.optimize import leastsq
+
+    par = dict(model_par)
+    cache = dict(resid_vals=None, jac_vals=None)
+
+    def calc_resid(vals):
+        if cache['resid_vals'] is None or np.any(vals != cache['resid_vals']):
+            par.update(zip(thawed, vals))
+            T_pin, T_dea = twodof.calc_twodof_model(states,
+                                                    tlm[0]['1pin1at'], tlm[0]['1pdeaat'],
+                                                    tlm.date, par, exact=True)
+            model = {'1pin1at': T_pin,
+                     '1pdeaat': T_dea}
+            cache['resid'] = np.hstack([tlm[x] - model[x] for x in msids])
+            cache['resid_vals'] = np.array(vals)
+            print '.',
+            sys.stdout.flush()
+        return cache['resid']
+
+    def calc_jac(vals):
+        if cache['jac_vals'] is None or np.any(vals != cache['jac_vals']):
+            par.update(zip(thawed, vals))
+            T_pin, T_dea, J_pin, J_dea = \
+                twodof.calc_twodof_jacobian(states,
+                                            tlm[0]['1pin1at'], tlm[0]['1pdeaat'],
+                                            tlm.date, par, exact=True, parnames=thawed)
+            jac = {'1pin1at': J_pin,
+                   '1pdeaat': J_dea}
+            cache['jac'] = np.vstack([-jac[x] for x in msids])
+            cache['jac_vals'] = np.array(vals)
+            print '+',
+            sys.stdout.flush()
+        return cache['jac']
+
+    vals0 = np.array([model_par[x] for x in thawed], dtype=float)
+    vals, cov, info, mesg, ier = leastsq(calc_resid, vals0, Dfun=calc_jac, full_output=1)
+    print
+    if ier not in (1, 2, 3, 4):
+        print 'WARNING: fit failed (%s), keeping previous parameter values' % mesg
+        return dict(model_par)
+    par.update(zip(thawed, vals))
+    return par
+
+def fit_model(dea, tlm, states):
+    """Fit the currently thawed ``dea`` parameters (``pin`` parameters are linked)
+    using the method specified by the --method option."""
+    if opt.method == 'jacobian':
+        thawed = [x for x in PARNAMES if not getattr(dea, x).frozen]
+        model_par = dict((x, getattr(dea, x).val) for x in PARNAMES)
+        fit_par = fit_jacobian(tlm, states, model_par, thawed)
+        for parname in thawed:
+            setattr(dea, parname, fit_par[parname])
+    else:
+        fit(1,2)
+
+def get_tlm_states(datestop='2009-06-01T00:00:00', ndays=180, cache_dir=None,
+                   mirror_file=None):
     datestop = Chandra.Time.DateTime(datestop)
 
     print 'Fetching telemetry for %d days before %s' % (ndays, datestop.date)
+    cache = telem_cache.TelemCache(cache_dir) if cache_dir else None
     tlm = psmc_check.get_telem_values(datestop.date,
                                       ['1pdeaat', '1pin1at'],
-                                      days=ndays, dt=300)
+                                      days=ndays, dt=300, cache=cache)
 
     print 'Getting states between %s : %s' % (tlm[0].date, tlm[-1].date)
-    db = Ska.DBI.DBI(dbi='sybase', user='aca_read')
+    db = db_provider.get_db(dbi='sybase', user='aca_read')
+    if mirror_file:
+        mirror = states_mirror.StatesMirror(mirror_file)
+        mirror.sync(db)
+        db = mirror.db
     states = psmc_check.get_states(tlm[0].date, tlm[-1].date, db)
     # Calc state values at tlm times
     indexes = np.searchsorted(states.tstop, tlm['date'])
@@ -134,7 +158,11 @@ def get_tlm_states(datestop='2009-06-01T00:00:00', ndays=180):
 
     return tlm, states, statevals
 
-def init_models_data(tlm, states, model_par, n_core):
+def init_models_data(tlm, states, model_par, n_core, pool=None):
+    """Load the 1pdeaat and 1pin1at telemetry as sherpa datasets 1 and 2 and
+    set up the ``dea`` and ``pin`` user models.  The two models share one
+    model cache and, if ``pool`` is given, are evaluated in ``n_core`` chunks
+    on that process pool.  The caller owns ``pool`` and must close it."""
     staterror = {'1pdeaat' : 1.0,
                  '1pdeabt' : 4.0,
                  '1pin1at' : 1.0}
@@ -152,12 +180,9 @@ def init_models_data(tlm, states, model_par, n_core):
     T_dea0 = dat1.y[0]
     T_pin0 = dat2.y[0]
 
-    if n_core > 0:
-        dea_temps = psmc_temps_model_multi('1pdeaat', tlm, states, n_core)
-        pin_temps = psmc_temps_model_multi('1pin1at', tlm, states, n_core)
-    else:
-        dea_temps = psmc_temps_model('1pdeaat', tlm, states)
-        pin_temps = psmc_temps_model('1pin1at', tlm, states)
+    cache = {}
+    dea_temps = psmc_temps_model('1pdeaat', tlm, states, cache, pool, n_core)
+    pin_temps = psmc_temps_model('1pin1at', tlm, states, cache, pool, n_core)
 
     set_stat('chi2gehrels')
 
@@ -175,6 +200,13 @@ def init_models_data(tlm, states, model_par, n_core):
 
     return dea, pin, dat1, dat2
 
+def print_eigsys_cache_stats(pool):
+    """Print the eigensystem cache statistics.  With a process pool the sherpa
+    models run in the pool workers, whose caches are not visible here, so
+    the statistics are only printed when the model runs in this process."""
+    if pool is None or opt.method == 'jacobian':
+        print 'Eigensystem cache:', twodof.eigsys_cache.stats()
+
 def print_model_par():
     print 'model_par = dict('
     for parname in PARNAMES:
@@ -268,7 +300,6 @@ def fitdea():
     print dea
 
 def killall():
-    import multiprocessing
     for p in multiprocessing.active_children():
         p.terminate()
 
@@ -296,6 +327,16 @@ def get_options():
                       action='store_false',
                       dest='fit',
                       help="Do not do fitting")
+    parser.add_option('--method',
+                      default='simplex',
+                      help="Fit method: simplex (sherpa) or jacobian "
+                      "(Levenberg-Marquardt with analytic model Jacobian)")
+    parser.add_option('--telem-cache',
+                      help="Directory for cached telemetry (default=None => "
+                      "fetch all telemetry from the archive)")
+    parser.add_option('--states-mirror',
+                      help="SQLite mirror of cmd_states, updated from Sybase "
+                      "(default=None => use Sybase)")
     parser.add_option('--n-core',
                       type='int',
                       default=0,
@@ -317,8 +358,11 @@ def main():
 
     # Fit HRC-I and HRC-S (typically for a longer period such as 365 days)
     model_par = characteristics.model_par
-    tlm, states, statevals = get_tlm_states(opt.datestop, opt.ndays_hrc)
-    dea, pin, dat1, dat2 = init_models_data(tlm, states, model_par, opt.n_core)
+    # One process pool for the models of both fit stages
+    pool = multiprocessing.Pool(opt.n_core) if opt.n_core > 0 else None
+    tlm, states, statevals = get_tlm_states(opt.datestop, opt.ndays_hrc, opt.telem_cache,
+                                            opt.states_mirror)
+    dea, pin, dat1, dat2 = init_models_data(tlm, states, model_par, opt.n_core, pool)
 
     print 'Original model pars:'
     print_model_par()
@@ -330,17 +374,19 @@ def main():
 
     print 'Fitting HRC-S and HRC-I settling temps at', time.ctime()
     if opt.fit:
-        fit(1,2)
+        fit_model(dea, tlm, states)
     freeze(dea)
     print 'Done at', time.ctime()
+    print_eigsys_cache_stats(pool)
 
     for parname in PARNAMES:
         model_par[parname] = getattr(dea, parname).val
 
     # Fit ACIS-I and ACIS-S and time constants (typically for a shorter period
     # such as 180 days).  This is because ACIS has more coverage and may vary faster.
-    tlm, states, statevals = get_tlm_states(opt.datestop, opt.ndays_acis)
-    dea, pin, dat1, dat2 = init_models_data(tlm, states, model_par, opt.n_core)
+    tlm, states, statevals = get_tlm_states(opt.datestop, opt.ndays_acis, opt.telem_cache,
+                                            opt.states_mirror)
+    dea, pin, dat1, dat2 = init_models_data(tlm, states, model_par, opt.n_core, pool)
     
     freeze(dea)
     for pitch in ('50', '90', '150'):
@@ -353,18 +399,20 @@ def main():
 
     print 'Fitting ACIS-I, ACIS-S and time constants at', time.ctime()
     if opt.fit:
-        fit(1,2)
+        fit_model(dea, tlm, states)
     freeze(dea)
     print 'Done at', time.ctime()
+    print_eigsys_cache_stats(pool)
 
     for parname in PARNAMES:
         model_par[parname] = getattr(dea, parname).val
 
     save_fit_figures(opt.figroot, dat1, statevals)
     print_model_par()
-    if opt.n_core > 0:
-        print 'Killing processes'
-        killall()
+    if pool is not None:
+        print 'Closing process pool'
+        pool.close()
+        pool.join()
     print 'Goodbye'
 
 if __name__ == '__main__':
@@ -377,6 +425,6 @@ if 'datestop' not in globals():
 if 'ndays' not in globals():
     ndays = 30
 tlm, states, statevals = get_tlm_states(datestop, ndays)
-dea, pin, dat1, dat2 = init_models_data(tlm, states)
+dea, pin, dat1, dat2 = init_models_data(tlm, states, characteristics.model_par, 0)
 plot_fit_resid(1)
 """
@@ -19,9 +19,11 @@ import re
 import time
 import shutil
 import pickle
+import json
+import contextlib
+import multiprocessing
 
 import numpy as np
-import Ska.DBI
 import Ska.Table
 import Ska.Numpy
 import Ska.engarchive.fetch_sci as fetch
@@ -30,6 +32,9 @@ from Chandra.Time import DateTime
 import Chandra.cmd_states as cmd_states
 import characteristics
 import twodof
+import telem_cache
+import states_mirror
+import db_provider
 
 # Matplotlib setup
 # Use Agg backend for command-line (non-interactive) operation
@@ -44,12 +49,65 @@ VERSION = 9
 MSID = dict(dea='1PDEAAT', pin='1PIN1AT')
 YELLOW = dict(dea=characteristics.T_dea_yellow, pin=characteristics.T_pin_yellow)
 MARGIN = dict(dea=characteristics.T_dea_margin, pin=characteristics.T_pin_margin)
+RED = dict(dea=characteristics.T_dea_red, pin=characteristics.T_pin_red)
+
+MC_PERCENTILES = (1, 16, 50, 84, 99)
+MC_CHUNK = 200                  # Monte Carlo samples per batched model call
+
+# State values stored with the validation model checkpoint
+CHECKPOINT_STATE_COLS = ('tstop', 'power', 'pitch', 'simpos')
 
 TASK_DATA = os.path.join(os.environ['SKA'], 'data', 'psmc')
 URL = "http://cxc.harvard.edu/mta/ASPECT/psmc_daily_check"
 
 logger = logging.getLogger('psmc_check')
 
+class StageTimer(object):
+    """Record the wall clock and CPU time of named processing stages.  Stages
+    can be nested, in which case the stage name includes the names of the
+    enclosing stages (e.g. ``week_predict/model``).
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """Clear all recorded stages."""
+        self.stages = []
+        self.stack = []
+        self.n_started = 0
+
+    def start(self, name):
+        """Start timing stage ``name``."""
+        self.stack.append((name, self.n_started, time.time(), os.times()))
+        self.n_started += 1
+
+    def stop(self):
+        """Stop timing the most recently started stage and record it."""
+        name, order, wall0, times0 = self.stack.pop()
+        times1 = os.times()
+        self.stages.append(dict(
+            name='/'.join([x[0] for x in self.stack] + [name]),
+            order=order,
+            depth=len(self.stack),
+            wall=time.time() - wall0,
+            cpu=(times1[0] - times0[0]) + (times1[1] - times0[1]),
+            cpu_children=(times1[2] - times0[2]) + (times1[3] - times0[3])))
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Context manager to time the enclosed block as stage ``name``."""
+        self.start(name)
+        try:
+            yield
+        finally:
+            self.stop()
+
+    def sorted_stages(self):
+        """Return the recorded stages in the order they were started."""
+        return sorted(self.stages, key=lambda x: x['order'])
+
+stage_timer = StageTimer()
+
 def get_options():
     from optparse import OptionParser
     parser = OptionParser()
@@ -78,10 +136,65 @@ def get_options():
                       type='float',
                       default=32.8,
                       help="Time step for model evaluation (sec)")
+    parser.add_option("--decimate-tol",
+                      type='float',
+                      help="Decimate output temperatures to this interpolation "
+                      "tolerance (degC, default=no decimation)")
+    parser.add_option("--n-mc",
+                      type='int',
+                      default=0,
+                      help="Number of Monte Carlo model samples for uncertainty "
+                      "envelopes (default=0 => no Monte Carlo)")
+    parser.add_option("--mc-par-sigma",
+                      type='float',
+                      default=0.01,
+                      help="Monte Carlo fractional 1-sigma of model parameters")
+    parser.add_option("--mc-T-sigma",
+                      type='float',
+                      default=1.0,
+                      help="Monte Carlo 1-sigma of initial temperatures (degC)")
+    parser.add_option("--mc-seed",
+                      type='int',
+                      help="Monte Carlo random number seed")
+    parser.add_option("--plot-procs",
+                      type='int',
+                      help="Number of processes for rendering plots (default=number "
+                      "of CPUs, 1 => no process pool)")
+    parser.add_option("--compact",
+                      action='store_true',
+                      help="Store predictions and telemetry as float32 "
+                      "(model propagation is still float64)")
     parser.add_option("--days",
                       type='float',
                       default=21.0,
                       help="Days of validation data (days)")
+    parser.add_option("--state-dir",
+                      help="Directory for model checkpoint and validation predictions "
+                      "used to resume the validation model run (default=None => "
+                      "always do a full run)")
+    parser.add_option("--reseed-days",
+                      type='float',
+                      default=7.0,
+                      help="Re-seed the validation model from telemetry with a full "
+                      "run when the checkpoint was seeded more than this many days "
+                      "ago (days)")
+    parser.add_option("--telem-cache",
+                      help="Directory for cached telemetry (default=None => "
+                      "fetch all telemetry from the archive)")
+    parser.add_option("--telem-cache-size",
+                      type='float',
+                      default=2000.,
+                      help="Maximum size of telemetry cache (MB)")
+    parser.add_option("--states-mirror",
+                      help="SQLite mirror of cmd_states and timeline_loads, updated "
+                      "from Sybase at the start of the run (default=None => use Sybase)")
+    parser.add_option("--db-standin",
+                      help="SQLite database file to use in place of Sybase "
+                      "(default=None => use Sybase)")
+    parser.add_option("--offline",
+                      action='store_true',
+                      help="Do not connect to Sybase and use only --states-mirror "
+                      "(validation only)")
     parser.add_option("--run_start_time",
                       help="Reference time to replace run start time for regression testing")
     parser.add_option("--traceback",
@@ -94,6 +207,9 @@ def get_options():
                       type='int',
                       default=1,
                       help="Verbosity (0=quiet, 1=normal, 2=debug)")
+    parser.add_option("--profile",
+                      action='store_true',
+                      help="Write a cProfile dump of the run to psmc_check.prof")
     parser.add_option("--version",
                       action='store_true',
                       help="Print version")
@@ -107,6 +223,13 @@ def main(opt):
 
     config_logging(opt.outdir, opt.verbose)
 
+    stage_timer.reset()
+    stage_timer.start('total')
+    if opt.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+
     # Store info relevant to processing for use in outputs
     proc = dict(run_user=os.environ['USER'],
                 run_time=time.ctime(),
@@ -123,14 +246,33 @@ def main(opt):
 
     logger.info('Command line options:\n%s\n' % pformat(opt.__dict__))
 
-    # Connect to database (NEED TO USE aca_read)
-    logger.info('Connecting to database to get cmd_states')
-    db = Ska.DBI.DBI(dbi='sybase', server='sybase', user='aca_read', database='aca')
+    if opt.offline and (opt.oflsdir is not None or not opt.states_mirror):
+        raise ValueError('--offline requires --states-mirror and cannot be used with '
+                         '--oflsdir (commands are only available from Sybase)')
+
+    # Database handle (NEED TO USE aca_read).  The connection is pooled and
+    # is made here so that its cost is timed as a separate stage.
+    db = None
+    if not opt.offline:
+        db_provider.set_standin(opt.db_standin)
+        db = db_provider.get_db(dbi='sybase', server='sybase', user='aca_read', database='aca')
+        with stage_timer.stage('connect_db'):
+            db.connect()
+
+    # Optionally sync and use the local mirror for cmd_states and timeline_loads
+    states_db = db
+    if opt.states_mirror:
+        with stage_timer.stage('states_mirror'):
+            mirror = states_mirror.StatesMirror(opt.states_mirror)
+            if db is not None:
+                mirror.sync(db, tnow=opt.run_start_time)
+            states_db = mirror.db
     
     tnow = DateTime(opt.run_start_time).secs
     if opt.oflsdir is not None:
         # Get tstart, tstop, commands from backstop file in opt.oflsdir
-        bs_cmds = get_bs_cmds(opt.oflsdir)
+        with stage_timer.stage('get_bs_cmds'):
+            bs_cmds = get_bs_cmds(opt.oflsdir)
         tstart = bs_cmds[0]['time']
         tstop = bs_cmds[-1]['time']
         
@@ -140,6 +282,7 @@ def main(opt):
         tstart = tnow
 
     # Get temperature telemetry for 3 weeks prior to min(tstart, NOW)
+    stage_timer.start('fetch_telem')
     tlm = get_telem_values(min(tstart, tnow),
                            ['1pdeaat', '1pin1at',
                             'sim_z', 'aosares1',
@@ -147,17 +290,24 @@ def main(opt):
                             '1dp28avo', '1dpicacu',
                             '1dp28bvo', '1dpicbcu'],
                            days=opt.days,
-                           name_map={'sim_z':'tscpos'})
+                           name_map={'sim_z':'tscpos'},
+                           dtype=get_out_dtype(opt),
+                           cache=get_telem_cache(opt))
     tlm['tscpos'] = tlm['tscpos'] * -397.7225924607
+    stage_timer.stop()
   
     # make predictions on oflsdir if defined
     if opt.oflsdir is not None:
-        pred = make_week_predict( opt, tstart, tstop, bs_cmds, tlm, db)
+        with stage_timer.stage('week_predict'):
+            pred = make_week_predict( opt, tstart, tstop, bs_cmds, tlm, db,
+                                      states_db=states_db)
     else:
-        pred = dict(plots=None, viols=None, times=None, states=None, temps=None)
+        pred = dict(plots=None, viols=None, times=None, states=None, temps=None,
+                    mc=None)
 
     # Validation
-    plots_validation = make_validation_plots(opt, tlm, db)
+    with stage_timer.stage('validation'):
+        plots_validation = make_validation_plots(opt, tlm, states_db)
     valid_viols = make_validation_viols(plots_validation)
     if len(valid_viols) > 0:
         # generate daily plot url if outdir in expected year/day format 
@@ -168,17 +318,43 @@ def main(opt):
         else:
             logger.info('validation warning(s) in output at %s' % opt.outdir )
 
-    write_index_rst(opt, proc, plots_validation, valid_viols=valid_viols, 
-                    plots=pred['plots'], viols=pred['viols'])
-    rst_to_html(opt, proc)
+    with stage_timer.stage('write_index_rst'):
+        write_index_rst(opt, proc, plots_validation, valid_viols=valid_viols, 
+                        plots=pred['plots'], viols=pred['viols'], mc=pred['mc'])
+    with stage_timer.stage('rst_to_html'):
+        rst_to_html(opt, proc)
+
+    stage_timer.stop()
+    if opt.profile:
+        profiler.disable()
+        outfile = os.path.join(opt.outdir, 'psmc_check.prof')
+        logger.info('Writing profile data to %s' % outfile)
+        profiler.dump_stats(outfile)
+    write_timing(opt)
     
     return dict(opt=opt, states=pred['states'], times=pred['times'],
                 temps=pred['temps'], plots=pred['plots'],
-                viols=pred['viols'], proc=proc, 
+                viols=pred['viols'], mc=pred['mc'], proc=proc, 
                 plots_validation=plots_validation)
 
 
-def make_week_predict(opt, tstart, tstop, bs_cmds, tlm, db):
+def make_week_predict(opt, tstart, tstop, bs_cmds, tlm, db, states_db=None):
+    """
+    Make the PSMC temperature predictions, plots and data files for the
+    backstop commands ``bs_cmds``.
+
+    :param opt: options
+    :param tstart: load start time (secs)
+    :param tstop: load stop time (secs)
+    :param bs_cmds: backstop commands
+    :param tlm: telemetry
+    :param db: database handle for cmds
+    :param states_db: database handle for cmd_states and timeline_loads
+                      (default=None => use ``db``)
+    :rtype: dict of prediction results
+    """
+    if states_db is None:
+        states_db = db
 
     # Try to make initial state0 from cmd line options
     state0 = dict((x, getattr(opt, x)) for x in ('pitch', 'simpos',
@@ -191,8 +367,9 @@ def make_week_predict(opt, tstart, tstop, bs_cmds, tlm, db):
     # If cmd lines options were not fully specified then get state0 as last
     # cmd_state that starts within available telemetry.  Update with the
     # mean temperatures at the start of state0.
+    stage_timer.start('cmd_states')
     if None in state0.values():
-        state0 = cmd_states.get_state0(tlm[-5].date, db, datepar='datestart')
+        state0 = cmd_states.get_state0(tlm[-5].date, states_db, datepar='datestart')
         ok = (tlm.date >= state0['tstart'] - 150) & (tlm.date <= state0['tstart'] + 150)
         state0.update({'T_dea': np.mean(tlm['1pdeaat'][ok]),
                        'T_pin': np.mean(tlm['1pin1at'][ok])})
@@ -210,9 +387,9 @@ def make_week_predict(opt, tstart, tstop, bs_cmds, tlm, db):
         cmds_datestop = bs_cmds[0]['date']    # *was* DateTime(bs_cmds[0]['time']).date
 
         # Get timeline load segments including state0 and beyond.
-        timeline_loads = db.fetchall("""SELECT * from timeline_loads
-                                        WHERE datestop > '%s' and datestart < '%s'"""
-                                     % (cmds_datestart, cmds_datestop))
+        timeline_loads = states_db.fetchall("""SELECT * from timeline_loads
+                                               WHERE datestop > '%s' and datestart < '%s'"""
+                                            % (cmds_datestart, cmds_datestop))
         logger.info('Found %s timeline_loads  after %s' % (len(timeline_loads), cmds_datestart))
 
         # Get cmds since datestart within timeline_loads
@@ -236,25 +413,144 @@ def make_week_predict(opt, tstart, tstop, bs_cmds, tlm, db):
 
     # Add power column based on ACIS commanding in states
     states = Ska.Numpy.add_column(states, 'power', get_power(states))
+    stage_timer.stop()
 
     # Create array of times at which to calculate PSMC temperatures, then do it.
     times = np.arange(state0['tstart'], tstop, opt.dt)
     logger.info('Calculating PSMC thermal model')
-    T_pin, T_dea = twodof.calc_twodof_model(states, state0['T_pin'], state0['T_dea'], times,
-                                            characteristics.model_par)
+    with stage_timer.stage('model'):
+        T_pin, T_dea = twodof.calc_twodof_model(states, state0['T_pin'], state0['T_dea'],
+                                                times, characteristics.model_par,
+                                                out_dtype=get_out_dtype(opt))
 
     # Make the PSMC limit check plots and data files
     plt.rc("axes", labelsize=10, titlesize=12)
     plt.rc("xtick", labelsize=10)
     plt.rc("ytick", labelsize=10)
     temps = dict(dea=T_dea, pin=T_pin)
-    plots = make_check_plots(opt, states, times, temps, tstart)
-    viols = make_viols(opt, states, times, temps)
-    write_states(opt, states)
-    write_temps(opt, times, temps)
+    with stage_timer.stage('viols'):
+        viols = make_viols(opt, states, state0)
+    mc = None
+    if opt.n_mc > 0:
+        with stage_timer.stage('monte_carlo'):
+            mc = make_mc_predict(opt, states, state0, times, viols)
+    out_times, out_temps = decimate_temps(opt, states, state0, times, temps)
+    with stage_timer.stage('check_plots'):
+        plots = make_check_plots(opt, states, out_times, out_temps, tstart, mc=mc)
+    with stage_timer.stage('write_outputs'):
+        write_states(opt, states)
+        write_temps(opt, out_times, out_temps)
+        if mc:
+            write_mc_temps(opt, times, mc)
 
     return dict(opt=opt, states=states, times=times, temps=temps,
-               plots=plots, viols=viols)
+               plots=plots, viols=viols, mc=mc)
+
+
+def decimate_temps(opt, states, state0, times, temps):
+    """
+    Keep only the temperature samples needed to reproduce the model to within
+    ``opt.decimate_tol`` degC by linear interpolation (see
+    twodof.calc_decimation_mask).  If ``opt.decimate_tol`` is not set the
+    inputs are returned unchanged.
+
+    :param opt: options
+    :param states: commanded states
+    :param state0: initial state (with T_pin and T_dea)
+    :param times: time stamps (sec) for temperature arrays
+    :param temps: dict of temperature arrays
+    :rtype: decimated (times, temps)
+    """
+    if not opt.decimate_tol:
+        return times, temps
+
+    ok = twodof.calc_decimation_mask(states, state0['T_pin'], state0['T_dea'], times,
+                                     characteristics.model_par, tol=opt.decimate_tol)
+    logger.info('Decimated temperatures to %d of %d samples (tolerance %.3f C)'
+                % (np.sum(ok), len(times), opt.decimate_tol))
+    return times[ok], dict((x, temps[x][ok]) for x in temps)
+
+def make_mc_predict(opt, states, state0, times, viols):
+    """
+    Propagate ``opt.n_mc`` Monte Carlo samples of the model parameters and
+    initial temperatures through ``states``.  Parameters are drawn with a
+    fractional 1-sigma of ``opt.mc_par_sigma`` and initial temperatures with a
+    1-sigma of ``opt.mc_T_sigma`` degC.  Samples are evaluated in batches with
+    twodof.calc_twodof_model_batch so the state schedule work is shared.
+
+    Each violation in ``viols`` gets a ``prob`` value giving the fraction of
+    samples that exceed the planning limit within the violation interval.
+    The samples are also evaluated at the time of the nominal maximum of each
+    violation and the interval includes the ``times`` samples bracketing it,
+    so violations shorter than the sample spacing are covered.
+
+    :param opt: options
+    :param states: commanded states
+    :param state0: initial state (with T_pin and T_dea)
+    :param times: time stamps (sec) for temperature arrays
+    :param viols: planning limit violations from make_viols()
+    :rtype: dict with percentile envelopes and exceedance probabilities per msid
+    """
+    logger.info('Calculating PSMC thermal model for %d Monte Carlo samples' % opt.n_mc)
+    rand = np.random.RandomState(opt.mc_seed)
+    par0 = np.array([characteristics.model_par[x] for x in twodof.PARNAMES])
+    n_times = len(times)
+    mc_temps = dict((x, np.empty((opt.n_mc, n_times), dtype='f4')) for x in MSID)
+
+    # Evaluate at the nominal maximum of each violation after ``times`` and
+    # find the ``times`` samples bracketing each violation interval.
+    tmaxs = []
+    viol_cols = {}
+    for msid in MSID:
+        viol_cols[msid] = []
+        for viol in viols[msid]:
+            i0 = max(np.searchsorted(times, viol['tstart']) - 1, 0)
+            i1 = np.searchsorted(times, viol['tstop'], side='right') + 1
+            viol_cols[msid].append((i0, i1, n_times + len(tmaxs)))
+            tmaxs.append(viol['tmax'])
+    eval_times = np.concatenate([times, np.array(tmaxs, dtype=float)])
+
+    # Exceedance of the planning limit is accumulated for each batch
+    plan_limit = dict((x, YELLOW[x] - MARGIN[x]) for x in MSID)
+    exceed = dict((x, np.zeros(opt.n_mc, dtype=bool)) for x in MSID)
+    viol_exceed = dict((x, np.zeros((opt.n_mc, len(viols[x])), dtype=bool)) for x in MSID)
+
+    for i0 in range(0, opt.n_mc, MC_CHUNK):
+        n_samp = min(MC_CHUNK, opt.n_mc - i0)
+        pars = par0 * (1 + opt.mc_par_sigma * rand.standard_normal((n_samp, len(par0))))
+        T_pin0 = state0['T_pin'] + opt.mc_T_sigma * rand.standard_normal(n_samp)
+        T_dea0 = state0['T_dea'] + opt.mc_T_sigma * rand.standard_normal(n_samp)
+        T_pin, T_dea = twodof.calc_twodof_model_batch(states, T_pin0, T_dea0, eval_times,
+                                                      pars, exact=True)
+        for msid, temps in (('pin', T_pin), ('dea', T_dea)):
+            mc_temps[msid][i0:i0 + n_samp] = temps[:, :n_times]
+            batch_exceed = temps >= plan_limit[msid]
+            for i, (j0, j1, j_max) in enumerate(viol_cols[msid]):
+                viol_exceed[msid][i0:i0 + n_samp, i] = (np.any(batch_exceed[:, j0:j1], axis=1)
+                                                        | batch_exceed[:, j_max])
+            exceed[msid][i0:i0 + n_samp] = np.any(batch_exceed[:, :n_times], axis=1)
+            if viol_cols[msid]:
+                exceed[msid][i0:i0 + n_samp] |= np.any(viol_exceed[msid][i0:i0 + n_samp],
+                                                        axis=1)
+
+    mc = dict(n_samples=opt.n_mc, percentiles=MC_PERCENTILES, times=times)
+    for msid in MSID:
+        # Percentiles are computed in place in the sample array
+        envelope = dict(zip(MC_PERCENTILES,
+                            np.percentile(mc_temps.pop(msid), MC_PERCENTILES, axis=0,
+                                          overwrite_input=True)))
+        prob = np.mean(exceed[msid])
+        logger.info('Monte Carlo probability of %s exceeding planning limit: %.3f'
+                    % (MSID[msid], prob))
+
+        for i, viol in enumerate(viols[msid]):
+            viol['prob'] = np.mean(viol_exceed[msid][:, i])
+            logger.info('Monte Carlo probability of %s violation from %s to %s: %.3f'
+                        % (MSID[msid], viol['datestart'], viol['datestop'], viol['prob']))
+
+        mc[msid] = dict(envelope=envelope, prob=prob, viols=viols[msid])
+
+    return mc
 
 
 def make_validation_viols(plots_validation):
@@ -310,7 +606,19 @@ def get_bs_cmds(oflsdir):
 
     return bs_cmds
 
-def get_telem_values(tstart, msids, days=14, dt=32.8, name_map={}):
+def get_out_dtype(opt):
+    """Return the dtype for stored predictions and telemetry values (None
+    implies the default float64)."""
+    return 'f4' if opt.compact else None
+
+def get_telem_cache(opt):
+    """Return the telemetry cache specified by options or None."""
+    if not opt.telem_cache:
+        return None
+    return telem_cache.TelemCache(opt.telem_cache, max_size=opt.telem_cache_size * 1e6)
+
+def get_telem_values(tstart, msids, days=14, dt=32.8, name_map={}, dtype=None,
+                     cache=None):
     """
     Fetch last ``days`` of available ``msids`` telemetry values before
     time ``tstart``.
@@ -320,24 +628,39 @@ def get_telem_values(tstart, msids, days=14, dt=32.8, name_map={}):
     :param days: length of telemetry request before ``tstart``
     :param dt: sample time (secs)
     :param name_map: dict mapping msid to recarray col name
+    :param dtype: dtype for telemetry values (default=None => as fetched).  The
+                  date column is always float64.
+    :param cache: telem_cache.TelemCache for fetched telemetry (default=None =>
+                  fetch all telemetry from the archive)
     :returns: np recarray of requested telemetry values from fetch
     """
     tstart = DateTime(tstart).secs
     start = DateTime(tstart - days * 86400).date
     stop = DateTime(tstart).date
-    logger.info('Fetching telemetry between %s and %s' % (start, stop))
-    msidset = fetch.Msidset(msids, start, stop)
-    start = max(x.times[0] for x in msidset.values())
-    stop = min(x.times[-1] for x in msidset.values())
-    msidset.interpolate(dt, start, stop)
+    if cache is not None:
+        logger.info('Getting telemetry between %s and %s from cache %s'
+                    % (start, stop, cache.cache_dir))
+        times, vals = telem_cache.get_msidset(cache, msids, start, stop, dt)
+        vals = [vals[x] for x in msids]
+    else:
+        logger.info('Fetching telemetry between %s and %s' % (start, stop))
+        msidset = fetch.Msidset(msids, start, stop)
+        start = max(x.times[0] for x in msidset.values())
+        stop = min(x.times[-1] for x in msidset.values())
+        # Use the same ``k * dt`` time grid as the telemetry cache
+        start = np.ceil(start / dt) * dt
+        msidset.interpolate(dt, start, stop)
+        times = msidset.times
+        vals = [msidset[x].vals for x in msids]
 
     # Finished when we found at least 10 good records (5 mins)
-    if len(msidset.times) < 10:
+    if len(times) < 10:
         raise ValueError('Found no telemetry within %d days of %s' % (days, str(tstart)))
 
     outnames = ['date'] + [name_map.get(x, x) for x in msids]
-    out = np.rec.fromarrays([msidset.times] + 
-                            [msidset[x].vals for x in msids],
+    if dtype is not None:
+        vals = [x.astype(dtype) for x in vals]
+    out = np.rec.fromarrays([times] + vals,
                             names=outnames)
     return out
 
@@ -399,8 +722,33 @@ def config_logging(outdir, verbose):
     filehandler.setFormatter(formatter)
     logger.addHandler(filehandler)
 
+def write_timing(opt):
+    """Log the wall clock and CPU time of each processing stage (to run.dat) and
+    write them to timing.json in opt.outdir."""
+    stages = stage_timer.sorted_stages()
+    logger.info('')
+    logger.info('%-32s %10s %10s %10s' % ('Stage', 'Wall (s)', 'CPU (s)', 'Child (s)'))
+    for stage in stages:
+        logger.info('%-32s %10.2f %10.2f %10.2f' % ('  ' * stage['depth'] + stage['name'].split('/')[-1],
+                                                    stage['wall'], stage['cpu'],
+                                                    stage['cpu_children']))
+    outfile = os.path.join(opt.outdir, 'timing.json')
+    logger.info('Writing stage timing to %s' % outfile)
+    out = open(outfile, 'w')
+    json.dump(stages, out, indent=2)
+    out.close()
+
+def write_npy(outfile, array):
+    """Write the structured ``array`` to the binary numpy file ``outfile``.
+    The columns are fixed width so readers can memory-map the file with
+    ``np.load(outfile, mmap_mode='r')``.  The file is written under a
+    temporary name and then renamed so readers never see a partial file."""
+    logger.info('Writing binary data to %s' % outfile)
+    np.save(outfile + '.tmp.npy', np.asarray(array))
+    os.rename(outfile + '.tmp.npy', outfile)
+
 def write_states(opt, states):
-    """Write states recarray to file states.dat"""
+    """Write states recarray to files states.dat and states.npy"""
     outfile = os.path.join(opt.outdir, 'states.dat')
     logger.info('Writing states to %s' % outfile)
     out = open(outfile, 'w')
@@ -415,9 +763,10 @@ def write_states(opt, states):
     newstates = np.rec.fromarrays([states[x] for x in newcols], names=newcols)
     Ska.Numpy.pprint(newstates, fmt, out)
     out.close()
+    write_npy(os.path.join(opt.outdir, 'states.npy'), newstates)
 
 def write_temps(opt, times, temps):
-    """Write temperature predictions to file temperatures.dat"""
+    """Write temperature predictions to files temperatures.dat and temperatures.npy"""
     outfile = os.path.join(opt.outdir, 'temperatures.dat')
     logger.info('Writing temperatures to %s' % outfile)
     T_dea = temps['dea']
@@ -431,8 +780,39 @@ def write_temps(opt, times, temps):
     out = open(outfile, 'w')
     Ska.Numpy.pprint(temp_array, fmt, out)
     out.close()
+    write_npy(os.path.join(opt.outdir, 'temperatures.npy'), temp_array)
+
+def write_validation_data(opt, tlm, pred):
+    """Write telemetry, model predictions and residuals (data - model) for
+    each validation MSID to file validation_data.npy with columns ``time``,
+    ``tlm_<msid>``, ``pred_<msid>`` and ``resid_<msid>``."""
+    names = ['time']
+    cols = [tlm.date]
+    for msid in sorted(pred):
+        names.extend(['tlm_' + msid, 'pred_' + msid, 'resid_' + msid])
+        cols.extend([tlm[msid], pred[msid], tlm[msid] - pred[msid]])
+    write_npy(os.path.join(opt.outdir, 'validation_data.npy'),
+              np.rec.fromarrays(cols, names=names))
+
+def write_mc_temps(opt, times, mc):
+    """Write Monte Carlo temperature percentile envelopes to file mc_temperatures.dat"""
+    outfile = os.path.join(opt.outdir, 'mc_temperatures.dat')
+    logger.info('Writing Monte Carlo temperatures to %s' % outfile)
+    names = ['time', 'date']
+    cols = [times, [DateTime(t).date for t in times]]
+    fmt = {'time': '%.2f'}
+    for msid in ('dea', 'pin'):
+        for perc in mc['percentiles']:
+            name = '%s_%02d' % (MSID[msid].lower(), perc)
+            names.append(name)
+            cols.append(mc[msid]['envelope'][perc])
+            fmt[name] = '%.2f'
+    out = open(outfile, 'w')
+    Ska.Numpy.pprint(np.rec.fromarrays(cols, names=names), fmt, out)
+    out.close()
 
-def write_index_rst(opt, proc, plots_validation, valid_viols=None, plots=None, viols=None):
+def write_index_rst(opt, proc, plots_validation, valid_viols=None, plots=None, viols=None,
+                    mc=None):
     """
     Make output text (in ReST format) in opt.outdir.
     """
@@ -449,6 +829,7 @@ def write_index_rst(opt, proc, plots_validation, valid_viols=None, plots=None, v
     django_context = django.template.Context({'opt': opt,
                                               'plots': plots,
                                               'viols': viols,
+                                              'mc': mc,
                                               'valid_viols': valid_viols,
                                               'proc': proc,
                                               'plots_validation': plots_validation,
@@ -459,30 +840,46 @@ def write_index_rst(opt, proc, plots_validation, valid_viols=None, plots=None, v
     template = django.template.Template(index_template)
     open(outfile, 'w').write(template.render(django_context))
 
-def make_viols(opt, states, times, temps):
+def make_viols(opt, states, state0):
     """
-    Find limit violations where predicted temperature is above the
-    yellow limit minus margin.
+    Find limit violations where the predicted temperature is above the
+    yellow limit minus margin (planning limit), the yellow limit or the red
+    limit.  Violation intervals and maximum temperatures are found exactly
+    from the closed-form model solution (see twodof.calc_limit_intervals).
+
+    :param opt: options
+    :param states: commanded states
+    :param state0: initial state (with T_pin and T_dea)
+    :rtype: dict of planning limit violations for each msid, plus lists of
+            ``yellow`` and ``red`` limit violations for all msids
     """
     logger.info('Checking for limit violations')
 
     viols = dict((x, []) for x in MSID)
+    viols.update(yellow=[], red=[])
     for msid in MSID:
-        temp = temps[msid]
-        plan_limit = YELLOW[msid] - MARGIN[msid]
-        bad = np.concatenate(([False],
-                             temp >= plan_limit,
-                             [False]))
-        changes = np.flatnonzero(bad[1:] != bad[:-1]).reshape(-1, 2)
-
-        for change in changes:
-            viol = {'datestart': DateTime(times[change[0]]).date,
-                    'datestop': DateTime(times[change[1]-1]).date,
-                    'maxtemp': temp[change[0]:change[1]].max()
-                    }
-            logger.info('WARNING: %s exceeds planning limit of %.2f degC from %s to %s' %
-                         (MSID[msid], plan_limit, viol['datestart'], viol['datestop']))
-            viols[msid].append(viol)
+        limits = (('planning', YELLOW[msid] - MARGIN[msid]),
+                  ('yellow', YELLOW[msid]),
+                  ('red', RED[msid]))
+        intervals = twodof.calc_limit_intervals(states, state0['T_pin'], state0['T_dea'],
+                                                characteristics.model_par,
+                                                [x[1] for x in limits],
+                                                msid=MSID[msid].lower())
+        for (level, limit), rows in zip(limits, intervals):
+            for row in rows:
+                viol = {'msid': MSID[msid],
+                        'limit': limit,
+                        'datestart': DateTime(row['tstart']).date,
+                        'datestop': DateTime(row['tstop']).date,
+                        'tstart': row['tstart'],
+                        'tstop': row['tstop'],
+                        'maxtemp': row['maxtemp'],
+                        'tmax': row['tmax'],
+                        'datemax': DateTime(row['tmax']).date,
+                        }
+                logger.info('WARNING: %s exceeds %s limit of %.2f degC from %s to %s' %
+                            (MSID[msid], level, limit, viol['datestart'], viol['datestop']))
+                viols[msid if level == 'planning' else level].append(viol)
     return viols
 
 def plot_two(fig_id, x, y, x2, y2,
@@ -523,7 +920,120 @@ def plot_two(fig_id, x, y, x2, y2,
 
     return {'fig': fig, 'ax': ax, 'ax2': ax2}
 
-def make_check_plots(opt, states, times, temps, tstart):
+def draw_temp_plot(fig_id, times, temps, state_times, pitch, title, yellow, margin,
+                   load_start, mc_times=None, mc_envelopes=()):
+    """Draw a temperature check plot with the yellow limit and planning limit
+    lines, the load start and optional Monte Carlo envelope curves.
+
+    :rtype: pyplot figure object
+    """
+    plot = plot_two(fig_id=fig_id,
+                    x=times,
+                    y=temps,
+                    x2=state_times,
+                    y2=pitch,
+                    title=title,
+                    xlabel='Date',
+                    ylabel='Temperature (C)',
+                    ylabel2='Pitch (deg)',
+                    ylim2=(40, 180),
+                    )
+    plot['ax'].axhline(yellow, linestyle='-', color='y', linewidth=2.0)
+    plot['ax'].axhline(yellow - margin, linestyle='--', color='y', linewidth=2.0)
+    plot['ax'].axvline(load_start, linestyle=':', color='g', linewidth=1.0)
+    if mc_envelopes:
+        xt = Ska.Matplotlib.cxctime2plotdate(mc_times)
+        for envelope in mc_envelopes:
+            plot['ax'].plot_date(xt, envelope, fmt='--', color='c', linewidth=1.0)
+    return plot['fig']
+
+def draw_pow_sim_plot(fig_id, state_times, power, simpos, load_start):
+    """Draw the PSMC power and SIM-Z position plot.
+
+    :rtype: pyplot figure object
+    """
+    plot = plot_two(fig_id=fig_id,
+                    title='PSMC power and SIM-Z position',
+                    xlabel='Date',
+                    x=state_times,
+                    y=power,
+                    ylabel='Power (watts)',
+                    ylim=(0, 160.),
+                    x2=state_times,
+                    y2=simpos,
+                    ylabel2='SIM-Z (steps)',
+                    ylim2=(-105000, 105000),
+                    )
+    plot['ax'].axvline(load_start, linestyle=':', color='g', linewidth=1.0)
+    plot['fig'].subplots_adjust(right=0.85)
+    return plot['fig']
+
+def draw_valid_lines_plot(fig_id, times, tlm_vals, pred_vals, title, ylabel):
+    """Draw a validation plot of telemetry (red) and model (blue) values.
+
+    :rtype: pyplot figure object
+    """
+    fig = plt.figure(fig_id, figsize=(7,3.5))
+    fig.clf()
+    ticklocs, fig, ax = plot_cxctime(times, tlm_vals, fig=fig, fmt='-r')
+    ticklocs, fig, ax = plot_cxctime(times, pred_vals, fig=fig, fmt='-b')
+    ax.set_title(title)
+    ax.set_ylabel(ylabel)
+    return fig
+
+def draw_valid_hist_plot(fig_id, resids, title, xlabel, log):
+    """Draw a histogram of validation residuals.
+
+    :rtype: pyplot figure object
+    """
+    fig = plt.figure(fig_id, figsize=(4,3))
+    fig.clf()
+    ax = fig.gca()
+    ax.hist(resids, bins=50, log=log)
+    ax.set_title(title)
+    ax.set_xlabel(xlabel)
+    fig.subplots_adjust(bottom=0.18)
+    return fig
+
+def render_plot(spec):
+    """Draw the figure for plot ``spec`` and write it to a PNG file.  This is
+    the process pool worker for ``render_plots()`` so ``spec`` must be
+    picklable.
+
+    :param spec: dict with ``draw`` (module level draw function), ``kwargs``
+                 (keyword args for ``draw``) and ``outfile`` (PNG file name)
+    :returns: ``outfile``
+    """
+    fig = spec['draw'](**spec['kwargs'])
+    fig.savefig(spec['outfile'])
+    plt.close(fig)
+    return spec['outfile']
+
+def render_plots(opt, specs):
+    """Render the plot ``specs`` (see ``render_plot()``).  The figures are
+    independent so with ``opt.plot_procs`` greater than 1 they are drawn and
+    written concurrently on a process pool.
+
+    :param opt: options
+    :param specs: list of plot specs
+    :returns: list of output file names
+    """
+    for spec in specs:
+        logger.info('Writing plot file %s' % spec['outfile'])
+    n_procs = opt.plot_procs or multiprocessing.cpu_count()
+    n_procs = min(n_procs, len(specs))
+    if n_procs <= 1:
+        return [render_plot(spec) for spec in specs]
+
+    pool = multiprocessing.Pool(n_procs)
+    try:
+        outfiles = pool.map(render_plot, specs)
+    finally:
+        pool.close()
+        pool.join()
+    return outfiles
+
+def make_check_plots(opt, states, times, temps, tstart, mc=None):
     """
     Make output plots.
     
@@ -533,54 +1043,47 @@ def make_check_plots(opt, states, times, temps, tstart):
     :param T_pin: 1pin1at temperatures
     :param T_dea: 1pddeat temperatures
     :param tstart: load start time 
+    :param mc: Monte Carlo results from make_mc_predict() (optional)
     :rtype: dict of review information including plot file names
     """
     plots = {}
+    specs = []
     
     # Start time of loads being reviewed expressed in units for plotdate()
     load_start = Ska.Matplotlib.cxctime2plotdate([tstart])[0]
+    state_times = pointpair(states['tstart'], states['tstop'])
 
     logger.info('Making temperature check plots')
     for fig_id, msid in enumerate(('dea', 'pin')):
-        plots[msid] = plot_two(fig_id=fig_id+1,
-                               x=times,
-                               y=temps[msid],
-                               x2=pointpair(states['tstart'], states['tstop']),
-                               y2=pointpair(states['pitch']),
-                               title=MSID[msid],
-                               xlabel='Date',
-                               ylabel='Temperature (C)',
-                               ylabel2='Pitch (deg)',
-                               ylim2=(40, 180),
-                               )
-        plots[msid]['ax'].axhline(YELLOW[msid], linestyle='-', color='y', linewidth=2.0)
-        plots[msid]['ax'].axhline(YELLOW[msid] - MARGIN[msid], linestyle='--', color='y', linewidth=2.0)
-        plots[msid]['ax'].axvline(load_start, linestyle=':', color='g', linewidth=1.0)
+        kwargs = dict(fig_id=fig_id+1,
+                      times=times,
+                      temps=temps[msid],
+                      state_times=state_times,
+                      pitch=pointpair(states['pitch']),
+                      title=MSID[msid],
+                      yellow=YELLOW[msid],
+                      margin=MARGIN[msid],
+                      load_start=load_start)
+        if mc:
+            kwargs['mc_times'] = mc['times']
+            kwargs['mc_envelopes'] = [mc[msid]['envelope'][perc]
+                                      for perc in (MC_PERCENTILES[0], MC_PERCENTILES[-1])]
         filename = MSID[msid].lower() + '.png'
-        outfile = os.path.join(opt.outdir, filename)
-        logger.info('Writing plot file %s' % outfile)
-        plots[msid]['fig'].savefig(outfile)
-        plots[msid]['filename'] = filename
-
-    plots['pow_sim'] = plot_two(fig_id=3,
-                                title='PSMC power and SIM-Z position',
-                                xlabel='Date',
-                                x=pointpair(states['tstart'], states['tstop']),
-                                y=pointpair(states['power']),
-                                ylabel='Power (watts)',
-                                ylim=(0, 160.),
-                                x2=pointpair(states['tstart'], states['tstop']),
-                                y2=pointpair(states['simpos']),
-                                ylabel2='SIM-Z (steps)',
-                                ylim2=(-105000, 105000),
-                           )
-    plots['pow_sim']['ax'].axvline(load_start, linestyle=':', color='g', linewidth=1.0)
-    plots['pow_sim']['fig'].subplots_adjust(right=0.85)
+        specs.append(dict(draw=draw_temp_plot, kwargs=kwargs,
+                          outfile=os.path.join(opt.outdir, filename)))
+        plots[msid] = dict(filename=filename)
+
     filename = 'pow_sim.png'
-    outfile = os.path.join(opt.outdir, filename)
-    logger.info('Writing plot file %s' % outfile)
-    plots['pow_sim']['fig'].savefig(outfile)
-    plots['pow_sim']['filename'] = filename
+    specs.append(dict(draw=draw_pow_sim_plot,
+                      kwargs=dict(fig_id=3,
+                                  state_times=state_times,
+                                  power=pointpair(states['power']),
+                                  simpos=pointpair(states['simpos']),
+                                  load_start=load_start),
+                      outfile=os.path.join(opt.outdir, filename)))
+    plots['pow_sim'] = dict(filename=filename)
+
+    render_plots(opt, specs)
 
     return plots
 
@@ -630,24 +1133,19 @@ def make_validation_plots(opt, tlm, db):
     :returns: list of plot info including plot file names
     """
     outdir = opt.outdir
-    states = get_states(tlm[0].date, tlm[-1].date, db)
-    tlm = Ska.Numpy.add_column(tlm, 'power', smoothed_power(tlm))
+    with stage_timer.stage('cmd_states'):
+        states = get_states(tlm[0].date, tlm[-1].date, db)
+    tlm = add_smoothed_power(opt, tlm)
 
     T_dea0 =  np.mean(tlm['1pdeaat'][:10])
     T_pin0 = np.mean(tlm['1pin1at'][:10])
 
     # Create array of times at which to calculate PSMC temperatures, then do it.
     logger.info('Calculating PSMC thermal model for validation')
-    T_pin, T_dea = twodof.calc_twodof_model(states, T_pin0, T_dea0, tlm.date,
-                                            characteristics.model_par)
+    with stage_timer.stage('model'):
+        T_pin, T_dea = calc_validation_temps(opt, states, T_pin0, T_dea0, tlm.date)
 
-    # Interpolate states onto the tlm.date grid
-    state_vals = cmd_states.interpolate_states(states, tlm.date)
-    pred = {'1pdeaat': T_dea,
-            '1pin1at': T_pin,
-            'aosares1': state_vals.pitch,
-            'tscpos': state_vals.simpos,
-            'power': state_vals.power,}
+    pred = get_validation_pred(opt, states, tlm.date, T_pin, T_dea)
 
     labels = {'1pdeaat': 'Degrees (C)',
               '1pin1at': 'Degrees (C)',
@@ -664,7 +1162,9 @@ def make_validation_plots(opt, tlm, db):
             'tscpos': '%d'}
 
     plots = []
+    specs = []
     logger.info('Making PSMC model validation plots and quantile table')
+    stage_timer.start('plots')
     quantiles = (1, 5, 16, 50, 84, 95, 99)
     # store lines of quantile table in a string and write out later
     quant_table = ''
@@ -672,17 +1172,16 @@ def make_validation_plots(opt, tlm, db):
     quant_table += quant_head + "\n"
     for fig_id, msid in enumerate(sorted(pred)):
         plot = dict(msid=msid.upper())
-        fig = plt.figure(10+fig_id, figsize=(7,3.5))
-        fig.clf()
         scale = scales.get(msid, 1.0)
-        ticklocs, fig, ax = plot_cxctime(tlm.date, tlm[msid] / scale, fig=fig, fmt='-r')
-        ticklocs, fig, ax = plot_cxctime(tlm.date, pred[msid] / scale, fig=fig, fmt='-b')
-        ax.set_title(msid.upper() + ' validation')
-        ax.set_ylabel(labels[msid])
         filename = msid + '_valid.png'
-        outfile = os.path.join(outdir, filename)
-        logger.info('Writing plot file %s' % outfile)
-        fig.savefig(outfile)
+        specs.append(dict(draw=draw_valid_lines_plot,
+                          kwargs=dict(fig_id=10+fig_id,
+                                      times=tlm.date,
+                                      tlm_vals=tlm[msid] / scale,
+                                      pred_vals=pred[msid] / scale,
+                                      title=msid.upper() + ' validation',
+                                      ylabel=labels[msid]),
+                          outfile=os.path.join(outdir, filename)))
         plot['lines'] = filename
 
         # Make quantiles
@@ -695,26 +1194,26 @@ def make_validation_plots(opt, tlm, db):
         quant_table += quant_line + "\n"
 
         for histscale in ('log', 'lin'):
-            fig = plt.figure(20+fig_id, figsize=(4,3))
-            fig.clf()
-            ax = fig.gca()
-            ax.hist(diff / scale, bins=50, log=(histscale=='log'))
-            ax.set_title(msid.upper() + ' residuals: data - model')
-            ax.set_xlabel(labels[msid])
-            fig.subplots_adjust(bottom=0.18)
             filename = '%s_valid_hist_%s.png' % (msid, histscale)
-            outfile = os.path.join(outdir, filename)
-            logger.info('Writing plot file %s' % outfile)
-            fig.savefig(outfile)
+            specs.append(dict(draw=draw_valid_hist_plot,
+                              kwargs=dict(fig_id=20+fig_id,
+                                          resids=diff / scale,
+                                          title=msid.upper() + ' residuals: data - model',
+                                          xlabel=labels[msid],
+                                          log=(histscale=='log')),
+                              outfile=os.path.join(outdir, filename)))
             plot['hist' + histscale] = filename
 
         plots.append(plot)
+    render_plots(opt, specs)
+    stage_timer.stop()
 
     filename = os.path.join(outdir, 'validation_quant.csv')
     logger.info('Writing quantile table %s' % filename)
     f = open(filename, 'w')
     f.write(quant_table)
     f.close()
+    write_validation_data(opt, tlm, pred)
     
     # If run_start_time is specified this is likely for regression testing
     # or other debugging.  In this case write out the full predicted and
@@ -728,6 +1227,148 @@ def make_validation_plots(opt, tlm, db):
 
     return plots
 
+def add_smoothed_power(opt, tlm):
+    """Return telemetry ``tlm`` with a ``power`` column of the smoothed PSMC
+    power (in the output dtype, see ``get_out_dtype()``)."""
+    power = smoothed_power(tlm)
+    if opt.compact:
+        power = power.astype(get_out_dtype(opt))
+    return Ska.Numpy.add_column(tlm, 'power', power)
+
+def get_validation_pred(opt, states, times, T_pin, T_dea):
+    """Return the dict of validation predictions at ``times``: model
+    temperatures ``T_pin`` and ``T_dea`` and the ``states`` values
+    interpolated onto ``times`` (in the output dtype, see
+    ``get_out_dtype()``)."""
+    state_vals = cmd_states.interpolate_states(states, times)
+    pred = {'1pdeaat': T_dea,
+            '1pin1at': T_pin,
+            'aosares1': state_vals.pitch,
+            'tscpos': state_vals.simpos,
+            'power': state_vals.power,}
+    if opt.compact:
+        pred = dict((x, pred[x].astype(get_out_dtype(opt))) for x in pred)
+    return pred
+
+def calc_validation_temps(opt, states, T_pin0, T_dea0, times):
+    """
+    Calculate the validation model temperatures at ``times``.  If
+    ``opt.state_dir`` is set and holds a valid checkpoint (same model
+    parameters and characteristics version) within the ``times`` span, along
+    with the previous run's predictions covering the times before the
+    checkpoint, then only the interval after the checkpoint is propagated.
+    Otherwise the model is run from ``T_pin0`` and ``T_dea0`` at the start.
+    A new checkpoint and predictions are then saved in ``opt.state_dir``.
+
+    The checkpoint is not used (and the model is re-seeded from telemetry
+    with a full run) if the model was last seeded more than
+    ``opt.reseed_days`` before the end of ``times`` or if any of the states
+    it was propagated through in the ``times`` span have changed.  The seed
+    time is the checkpoint time of the last full run.
+
+    :param opt: options
+    :param states: commanded states covering ``times``
+    :param T_pin0: initial 1pin1at (degC)
+    :param T_dea0: initial 1pdeaat (degC)
+    :param times: times (secs) for model temperatures
+    :returns: T_pin, T_dea
+    """
+    model_par = characteristics.model_par
+    out_dtype = get_out_dtype(opt)
+    if not opt.state_dir:
+        return twodof.calc_twodof_model(states, T_pin0, T_dea0, times, model_par,
+                                        out_dtype=out_dtype)
+
+    if not os.path.exists(opt.state_dir):
+        os.makedirs(opt.state_dir)
+    checkpoint_file = os.path.join(opt.state_dir, 'checkpoint.json')
+    pred_file = os.path.join(opt.state_dir, 'validation_pred.npz')
+
+    checkpoint = twodof.read_checkpoint(checkpoint_file, model_par)
+    prev = None
+    if os.path.exists(pred_file):
+        npz = np.load(pred_file)
+        prev = dict((name, npz[name]) for name in ('times', 'T_pin', 'T_dea'))
+        npz.close()
+    resume = (checkpoint is not None and prev is not None
+              and 'seed_time' in checkpoint
+              and times[-1] - checkpoint['seed_time'] <= opt.reseed_days * 86400
+              and times[0] <= checkpoint['time'] <= times[-1]
+              and prev['times'][0] <= times[0]
+              and prev['times'][-1] >= checkpoint['time'])
+    if resume:
+        resume = not checkpoint_states_changed(checkpoint, states)
+        if not resume:
+            logger.info('Commanded states before the model checkpoint changed')
+    if resume:
+        new_states = states[states['tstart'] >= checkpoint['time'] - 1.0]
+        resume = (len(new_states) > 0
+                  and abs(new_states[0]['tstart'] - checkpoint['time']) < 1.0)
+
+    if resume:
+        logger.info('Resuming validation model from checkpoint at %s'
+                    % DateTime(checkpoint['time']).date)
+        seed_time = checkpoint['seed_time']
+        new = times >= checkpoint['time']
+        T_pin = np.empty(len(times), dtype=out_dtype or float)
+        T_dea = np.empty(len(times), dtype=out_dtype or float)
+        T_pin[new], T_dea[new] = twodof.calc_twodof_model(
+            new_states, checkpoint['T_pin'], checkpoint['T_dea'], times[new], model_par)
+        T_pin[~new] = Ska.Numpy.interpolate(prev['T_pin'], prev['times'], times[~new])
+        T_dea[~new] = Ska.Numpy.interpolate(prev['T_dea'], prev['times'], times[~new])
+        checkpoint = twodof.calc_checkpoint(new_states, checkpoint['T_pin'],
+                                            checkpoint['T_dea'], model_par)
+    else:
+        logger.info('No valid model checkpoint in %s: doing full run' % opt.state_dir)
+        T_pin, T_dea = twodof.calc_twodof_model(states, T_pin0, T_dea0, times, model_par,
+                                                out_dtype=out_dtype)
+        checkpoint = twodof.calc_checkpoint(states, T_pin0, T_dea0, model_par)
+        seed_time = checkpoint['time']
+    checkpoint['seed_time'] = seed_time
+    checkpoint['states'] = get_checkpoint_states(states, checkpoint['time'])
+
+    logger.info('Writing model checkpoint at %s to %s'
+                % (DateTime(checkpoint['time']).date, checkpoint_file))
+    np.savez(pred_file + '.tmp.npz', times=times, T_pin=T_pin, T_dea=T_dea)
+    os.rename(pred_file + '.tmp.npz', pred_file)
+    twodof.write_checkpoint(checkpoint_file, checkpoint)
+
+    return T_pin, T_dea
+
+def get_checkpoint_states(states, time):
+    """Return the ``CHECKPOINT_STATE_COLS`` values (as lists) of the
+    ``states`` starting before the checkpoint ``time``.  These are stored
+    with the checkpoint so that later runs can detect changed states.
+    ``tstart`` is not included because the first state is clipped to the
+    start of the validation window; for contiguous states every state
+    boundary is also the ``tstop`` of the previous state.
+
+    :param states: commanded states
+    :param time: checkpoint time (secs)
+    """
+    cols = twodof.get_state_arrays(states)
+    ok = cols['tstart'] < time - 1.0
+    return dict((col, cols[col][ok].tolist()) for col in CHECKPOINT_STATE_COLS)
+
+def checkpoint_states_changed(checkpoint, states):
+    """Return True if any of the ``states`` before the ``checkpoint`` time
+    differ from the states stored with the checkpoint.  Only the overlap with
+    ``states`` is compared since the validation window moves between runs.
+
+    :param checkpoint: checkpoint dict
+    :param states: commanded states covering the validation window
+    """
+    if 'states' not in checkpoint:
+        return True
+    prev = dict((col, np.array(checkpoint['states'][col], dtype=float))
+                for col in CHECKPOINT_STATE_COLS)
+    curr = get_checkpoint_states(states, checkpoint['time'])
+    ok = prev['tstop'] > states[0]['tstart']
+    if np.count_nonzero(ok) != len(curr['tstop']):
+        return True
+    return not all(np.allclose(prev[col][ok], curr[col], rtol=1e-12, atol=1e-9)
+                   for col in CHECKPOINT_STATE_COLS)
+
 def plot_cxctime(times, y, fig=None, **kwargs):
     """Make a date plot where the X-axis values are in CXC time.  If no ``fig``
     value is supplied then the current figure will be used (and created
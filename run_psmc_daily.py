@@ -49,8 +49,13 @@ def main(opt):
     if not os.path.exists(day_dir):
         os.makedirs(day_dir)
     print PSMC_CHECK_EXE
-    os.system("%s --run_start_time %s --days %s --outdir %s" 
-              % ( PSMC_CHECK_EXE, run_time_date, opt.telem_days, day_dir))
+    state_dir = os.path.join(opt.data_dir, 'state')
+    cache_dir = os.path.join(opt.data_dir, 'telem_cache')
+    mirror_file = os.path.join(state_dir, 'cmd_states.db3')
+    os.system("%s --run_start_time %s --days %s --outdir %s --state-dir %s --telem-cache %s "
+              "--states-mirror %s"
+              % ( PSMC_CHECK_EXE, run_time_date, opt.telem_days, day_dir, state_dir,
+                  cache_dir, mirror_file))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,111 @@
+"""
+Local SQLite mirror of the ``cmd_states`` and ``timeline_loads`` tables used
+by psmc_check and psmc_calibrate.
+
+Commanded states in the past almost never change, so each sync only copies
+the rows starting after the end of the mirror or ending within
+``REFRESH_DAYS`` of the current time (recent and future states change when
+loads are replanned or interrupted, and an interruption can cut short the
+``datestop`` of a row that started well before the refresh window).  The
+mirror is an ordinary ``Ska.DBI`` sqlite database so it can be used in place
+of the Sybase handle for ``psmc_check.get_states``,
+``Chandra.cmd_states.get_state0`` and the ``timeline_loads`` query, including
+for offline runs.  The ``cmds`` table is not mirrored.
+"""
+
+import os
+import time
+import logging
+
+from Chandra.Time import DateTime
+
+import db_provider
+
+TABLES = ('cmd_states', 'timeline_loads')
+
+# Rows stopping within this many days before now (or later) are refreshed on each sync
+REFRESH_DAYS = 7.0
+
+logger = logging.getLogger('psmc_check.states_mirror')
+
+def sql_type(dtype):
+    """Return the SQL column type for numpy ``dtype``."""
+    if dtype.kind == 'f':
+        return 'float'
+    elif dtype.kind in 'iub':
+        return 'int'
+    else:
+        return 'varchar(%d)' % max(dtype.itemsize // (4 if dtype.kind == 'U' else 1), 1)
+
+class StatesMirror(object):
+    """SQLite mirror of the ``cmd_states`` and ``timeline_loads`` tables.
+
+    :param filename: SQLite database file (created if needed)
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        dirname = os.path.dirname(filename)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        self.db = db_provider.get_db(dbi='sqlite', server=filename)
+
+    def has_table(self, table):
+        """Return True if ``table`` exists in the mirror."""
+        row = self.db.fetchone("SELECT name FROM sqlite_master WHERE type='table' "
+                               "AND name='%s'" % table)
+        return row is not None
+
+    def create_table(self, table, rows):
+        """Create ``table`` in the mirror with columns matching the recarray
+        ``rows`` fetched from the source database."""
+        cols = ['%s %s' % (name, sql_type(rows.dtype[name])) for name in rows.dtype.names]
+        self.db.execute('CREATE TABLE %s (%s)' % (table, ', '.join(cols)))
+        self.db.execute('CREATE INDEX %s_datestart ON %s (datestart)' % (table, table))
+        self.db.execute('CREATE INDEX %s_datestop ON %s (datestop)' % (table, table))
+
+    def last_datestart(self, table):
+        """Return the last ``datestart`` in ``table`` or None if it is empty."""
+        row = self.db.fetchone('SELECT max(datestart) AS datestart FROM %s' % table)
+        return row['datestart'] if row else None
+
+    def sync(self, db, tnow=None, refresh_days=REFRESH_DAYS):
+        """Copy new and recently changed rows of each table from the source
+        database ``db``.  Rows in the mirror starting after the end of the
+        mirror or stopping on or after the refresh date are replaced by the
+        source rows in one transaction.
+
+        :param db: source database handle (e.g. Sybase aca)
+        :param tnow: reference time for the refresh window (default=now)
+        :param refresh_days: days before ``tnow`` to refresh
+        """
+        if tnow is None:
+            tnow = DateTime(time.time(), format='unix').secs
+        refresh_date = DateTime(DateTime(tnow).secs - refresh_days * 86400).date
+
+        for table in TABLES:
+            exists = self.has_table(table)
+            datestart = None
+            where = None
+            if exists:
+                last = self.last_datestart(table)
+                if last is not None:
+                    datestart = min(last, refresh_date)
+                    where = ("datestart >= '%s' OR datestop >= '%s'"
+                             % (datestart, refresh_date))
+
+            query = 'SELECT * FROM %s' % table
+            if where is not None:
+                query += ' WHERE ' + where
+            rows = db.fetchall(query + ' ORDER BY datestart')
+            logger.info('Syncing %d %s rows from %s to mirror %s'
+                        % (len(rows), table, datestart or 'start', self.filename))
+            if not exists:
+                if len(rows) == 0:
+                    continue
+                self.create_table(table, rows)
+            if where is not None:
+                self.db.execute('DELETE FROM %s WHERE %s' % (table, where), commit=False)
+            names = rows.dtype.names
+            for row in rows:
+                self.db.insert(dict(zip(names, row.tolist())), table, commit=False)
+            self.db.commit()
@@ -0,0 +1,212 @@
+"""
+Persistent on-disk cache of fetched and interpolated engineering telemetry.
+
+Telemetry for each MSID is filtered for bad quality samples, interpolated
+(nearest neighbor) onto the fixed time grid ``t = k * dt`` (CXC seconds) and
+stored in chunks of one day (``day = floor(t / 86400)``) with one file per
+MSID, ``dt`` and day::
+
+  <cache_dir>/<msid>/dt<dt>/<day>.npz
+
+Only the chunks missing from the cache are fetched from the engineering
+archive and contiguous missing days are fetched with a single query.  Days
+that are not completely covered by telemetry (e.g. the current day) are
+returned but not stored.  Chunk files are written atomically (temporary file
+then rename) so concurrent processes can share one cache directory, and the
+least recently used chunks are removed when the cache exceeds its size limit.
+"""
+
+import os
+import logging
+import tempfile
+
+import numpy as np
+import Ska.Numpy
+import Ska.engarchive.fetch_sci as fetch
+from Chandra.Time import DateTime
+
+DAY = 86400.
+
+logger = logging.getLogger('psmc_check.telem_cache')
+
+class TelemCache(object):
+    """On-disk cache of interpolated telemetry in per-day chunks.
+
+    :param cache_dir: cache root directory
+    :param max_size: maximum total size of chunk files (bytes)
+    """
+    def __init__(self, cache_dir, max_size=2e9):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+
+    def chunk_path(self, msid, dt, day):
+        """Return the file name of the chunk for ``msid``, ``dt`` and ``day``."""
+        return os.path.join(self.cache_dir, msid.lower(), 'dt%g' % dt, '%d.npz' % day)
+
+    def read_chunk(self, msid, dt, day):
+        """Return the (times, vals) arrays of a cached chunk or None if the
+        chunk is not in the cache.  Reading a chunk marks it as recently used."""
+        path = self.chunk_path(msid, dt, day)
+        try:
+            chunk = np.load(path)
+            try:
+                out = chunk['times'], chunk['vals']
+            finally:
+                chunk.close()
+            os.utime(path, None)
+        except (IOError, OSError):
+            # Missing, or removed by another process since the check
+            return None
+        return out
+
+    def write_chunk(self, msid, dt, day, times, vals):
+        """Atomically write a chunk to the cache."""
+        path = self.chunk_path(msid, dt, day)
+        dirname = os.path.dirname(path)
+        try:
+            os.makedirs(dirname)
+        except OSError:
+            if not os.path.isdir(dirname):
+                raise
+        fd, tmp_path = tempfile.mkstemp(dir=dirname, suffix='.tmp')
+        try:
+            out = os.fdopen(fd, 'wb')
+            np.savez(out, times=times, vals=vals)
+            out.close()
+            os.rename(tmp_path, path)
+        except:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+
+    def fetch_days(self, msid, dt, day0, day1):
+        """Fetch ``msid`` telemetry for days ``day0`` through ``day1 - 1`` from
+        the engineering archive and interpolate onto the ``dt`` grid.  Days that
+        are completely covered by telemetry are written to the cache.
+
+        :rtype: dict of (times, vals) for each day with data
+        """
+        tstart = day0 * DAY
+        tstop = day1 * DAY
+        logger.info('Fetching %s telemetry between %s and %s'
+                    % (msid, DateTime(tstart).date, DateTime(tstop).date))
+        # Msid (unlike MSID) filters bad quality samples, as for fetch.Msidset
+        dat = fetch.Msid(msid, DateTime(tstart - dt).date, DateTime(tstop + dt).date)
+        chunks = {}
+        if len(dat.times) == 0:
+            return chunks
+
+        k0 = int(np.ceil(max(tstart, dat.times[0]) / dt))
+        k1 = int(np.floor(min(tstop, dat.times[-1]) / dt)) + 1
+        times = np.arange(k0, k1) * dt
+        times = times[times < tstop]
+        vals = Ska.Numpy.interpolate(dat.vals, dat.times, times, method='nearest')
+
+        days = np.floor(times / DAY).astype(int)
+        for day in np.unique(days):
+            ok = days == day
+            chunks[day] = times[ok], vals[ok]
+            complete = (dat.times[0] <= day * DAY + dt
+                        and dat.times[-1] >= (day + 1) * DAY - dt)
+            if complete:
+                self.write_chunk(msid, dt, day, times[ok], vals[ok])
+        return chunks
+
+    def get(self, msid, start, stop, dt):
+        """Return the interpolated ``msid`` telemetry at the grid times
+        ``k * dt`` between ``start`` and ``stop``, fetching only the days that
+        are not in the cache.
+
+        :param msid: MSID name
+        :param start: start time (any Chandra.Time format)
+        :param stop: stop time (any Chandra.Time format)
+        :param dt: grid spacing (secs)
+        :rtype: times, vals
+        """
+        tstart = DateTime(start).secs
+        tstop = DateTime(stop).secs
+        days = range(int(np.floor(tstart / DAY)), int(np.floor(tstop / DAY)) + 1)
+
+        chunks = {}
+        missing = []
+        for day in days:
+            chunk = self.read_chunk(msid, dt, day)
+            if chunk is None:
+                missing.append(day)
+            else:
+                chunks[day] = chunk
+        logger.info('Telemetry cache has %d of %d days for %s'
+                    % (len(days) - len(missing), len(days), msid))
+
+        # Fetch each run of contiguous missing days with one archive query
+        i0 = 0
+        while i0 < len(missing):
+            i1 = i0 + 1
+            while i1 < len(missing) and missing[i1] == missing[i1 - 1] + 1:
+                i1 += 1
+            chunks.update(self.fetch_days(msid, dt, missing[i0], missing[i1 - 1] + 1))
+            i0 = i1
+        if missing:
+            self.evict()
+
+        chunks = [chunks[day] for day in days if day in chunks]
+        if not chunks:
+            return np.zeros(0), np.zeros(0)
+        times = np.concatenate([x[0] for x in chunks])
+        vals = np.concatenate([x[1] for x in chunks])
+        ok = (times >= tstart) & (times <= tstop)
+        return times[ok], vals[ok]
+
+    def size(self):
+        """Return the total size (bytes) of chunk files in the cache."""
+        return sum(x[2] for x in self.chunk_files())
+
+    def chunk_files(self):
+        """Return a list of (mtime, path, size) for all chunk files."""
+        files = []
+        for dirpath, dirnames, filenames in os.walk(self.cache_dir):
+            for filename in filenames:
+                if not filename.endswith('.npz'):
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, path, stat.st_size))
+        return files
+
+    def evict(self):
+        """Remove least recently used chunks until the cache is no larger than
+        ``max_size``."""
+        files = sorted(self.chunk_files())
+        size = sum(x[2] for x in files)
+        for mtime, path, file_size in files:
+            if size <= self.max_size:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            size -= file_size
+            logger.debug('Evicted telemetry cache chunk %s' % path)
+
+def get_msidset(cache, msids, start, stop, dt):
+    """Return telemetry for ``msids`` between ``start`` and ``stop`` from
+    ``cache`` on a common time grid.  Only grid times where all ``msids`` have
+    data are included.
+
+    :param cache: TelemCache object
+    :param msids: list of MSID names
+    :param start: start time (any Chandra.Time format)
+    :param stop: stop time (any Chandra.Time format)
+    :param dt: grid spacing (secs)
+    :rtype: times, dict of vals arrays for each MSID
+    """
+    dats = dict((msid, cache.get(msid, start, stop, dt)) for msid in msids)
+    times = dats[msids[0]][0]
+    for msid in msids[1:]:
+        times = np.intersect1d(times, dats[msid][0])
+    vals = dict((msid, dats[msid][1][np.searchsorted(dats[msid][0], times)])
+                for msid in msids)
+    return times, vals
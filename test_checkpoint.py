@@ -0,0 +1,89 @@
+"""
+Check that a daily validation run one day after a full run resumes from the
+model checkpoint, gives the same temperatures as a full run from the same
+seed, and falls back to a full run when states before the checkpoint change.
+"""
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+import psmc_check
+import twodof
+import characteristics as char
+
+days = 21.0
+dt = 328.0
+pin0 = 35.
+dea0 = 25.
+
+
+class Opt(object):
+    compact = False
+    reseed_days = 7.0
+
+    def __init__(self, state_dir):
+        self.state_dir = state_dir
+
+
+def make_states(n_states, seed):
+    """Random schedule of ``n_states`` half-day (on average) states."""
+    rand = np.random.RandomState(seed)
+    durs = rand.uniform(10000., 80000., n_states)
+    tstops = np.cumsum(durs)
+    tstarts = np.concatenate([[0.], tstops[:-1]])
+    return np.rec.fromarrays([tstarts, tstops,
+                              rand.uniform(40., 140., n_states),
+                              rand.uniform(46., 170., n_states),
+                              rand.choice([-99616., -50504., 75624., 92904.], n_states)],
+                             names=['tstart', 'tstop', 'power', 'pitch', 'simpos'])
+
+
+def get_window(all_states, tstart):
+    """Times and states for a validation window starting at ``tstart``,
+    with the first state clipped to the window as for psmc_check.get_states."""
+    times = np.arange(tstart, tstart + days * 86400, dt)
+    ok = (all_states['tstop'] > times[0]) & (all_states['tstart'] < times[-1])
+    states = all_states[ok].copy()
+    states[0].tstart = times[0] - 0.01
+    return times, states
+
+
+def read_checkpoint(state_dir):
+    return json.load(open(os.path.join(state_dir, 'checkpoint.json')))
+
+
+def test_resume():
+    all_states = make_states(100, 1)
+    state_dir = tempfile.mkdtemp()
+    try:
+        opt = Opt(state_dir)
+        times1, states1 = get_window(all_states, 0.0)
+        psmc_check.calc_validation_temps(opt, states1, pin0, dea0, times1)
+        checkpoint1 = read_checkpoint(state_dir)
+        assert checkpoint1['seed_time'] == checkpoint1['time']
+
+        times2, states2 = get_window(all_states, 86400.0)
+        T_pin, T_dea = psmc_check.calc_validation_temps(opt, states2, 0.0, 0.0, times2)
+        checkpoint2 = read_checkpoint(state_dir)
+        assert checkpoint2['time'] > checkpoint1['time']
+        assert checkpoint2['seed_time'] == checkpoint1['seed_time']
+
+        # Same as a full run from the first run's seed
+        ok = all_states['tstart'] < times2[-1]
+        ref_pin, ref_dea = twodof.calc_twodof_model(all_states[ok], pin0, dea0, times2,
+                                                    char.model_par)
+        assert np.allclose(T_pin, ref_pin, rtol=0, atol=0.01)
+        assert np.allclose(T_dea, ref_dea, rtol=0, atol=0.01)
+
+        # Change a state inside the window before the checkpoint
+        changed = all_states.copy()
+        i = np.searchsorted(changed['tstart'], 10 * 86400.0)
+        changed[i].power += 20.0
+        times3, states3 = get_window(changed, 2 * 86400.0)
+        psmc_check.calc_validation_temps(opt, states3, pin0, dea0, times3)
+        checkpoint3 = read_checkpoint(state_dir)
+        assert checkpoint3['seed_time'] == checkpoint3['time']
+        assert checkpoint3['seed_time'] > checkpoint2['seed_time']
+    finally:
+        shutil.rmtree(state_dir)
@@ -0,0 +1,118 @@
+"""
+Check the compact (float32) output policy: telemetry from get_telem_values,
+the validation power and predictions, and the validation_data output are
+float32 with the time columns kept float64, and the model residual
+statistics are unchanged relative to the default float64 outputs.
+"""
+import os
+import shutil
+import tempfile
+import numpy as np
+import psmc_check
+import twodof
+import characteristics as char
+
+cols = 'tstart  tstop  power  pitch  simpos'.split()
+states = []
+states.append((    0., 100000.,  40., 150., -99162))
+states.append((100000., 200000.,  80.,  90., -50360))
+states.append((200000., 300000., 100., 130.,  75766))
+states.append((300000., 400000., 120.,  55.,  93718))
+
+states = np.rec.fromrecords(states, names=cols)
+
+dea0 = 25.
+pin0 = 35.
+times = np.arange(states['tstart'][0], states['tstop'][-1], 32.8)
+quantiles = (1, 5, 16, 50, 84, 95, 99)
+power_msids = ['1de28avo', '1deicacu', '1dp28avo', '1dpicacu', '1dp28bvo', '1dpicbcu']
+
+
+class Opt(object):
+    compact = True
+
+    def __init__(self, outdir=None):
+        self.outdir = outdir
+
+
+def fake_telem(T, seed):
+    """Model temperatures plus noise and telemetry quantization (0.1 degC)"""
+    np.random.seed(seed)
+    return np.round((T + np.random.normal(0.0, 0.5, len(T))) * 10.0) / 10.0
+
+
+def resid_stats(resid):
+    resid = resid.astype(np.float64)
+    return np.array([resid.mean(), resid.std()] +
+                    [np.percentile(resid, x) for x in quantiles])
+
+
+def fake_tlm(msids, seed):
+    """Float32 telemetry recarray at ``times`` with random values"""
+    np.random.seed(seed)
+    vals = [np.random.uniform(1.0, 30.0, len(times)).astype(np.float32) for x in msids]
+    return np.rec.fromarrays([times] + vals, names=['date'] + msids)
+
+
+def test_get_telem_values_dtype():
+    tlm = psmc_check.get_telem_values('2010:100:12:00:00.000', ['1pdeaat', 'sim_z'],
+                                      days=1.0, name_map={'sim_z': 'tscpos'}, dtype='f4')
+    assert tlm['date'].dtype == np.float64
+    assert tlm['1pdeaat'].dtype == np.float32
+    assert tlm['tscpos'].dtype == np.float32
+
+
+def test_validation_dtype():
+    opt = Opt()
+    tlm = psmc_check.add_smoothed_power(opt, fake_tlm(power_msids, seed=0))
+    assert tlm['date'].dtype == np.float64
+    assert tlm['power'].dtype == np.float32
+
+    T_pin, T_dea = twodof.calc_twodof_model(states, pin0, dea0, times, char.model_par,
+                                            out_dtype='f4')
+    assert T_pin.dtype == np.float32
+    assert T_dea.dtype == np.float32
+    pred = psmc_check.get_validation_pred(opt, states, times, T_pin, T_dea)
+    for msid in pred:
+        assert pred[msid].dtype == np.float32, msid
+
+
+def test_validation_data_dtype():
+    opt = Opt(tempfile.mkdtemp())
+    try:
+        T_pin, T_dea = twodof.calc_twodof_model(states, pin0, dea0, times, char.model_par,
+                                                out_dtype='f4')
+        pred = psmc_check.get_validation_pred(opt, states, times, T_pin, T_dea)
+        tlm = fake_tlm(sorted(pred), seed=1)
+        psmc_check.write_validation_data(opt, tlm, pred)
+        out = np.load(os.path.join(opt.outdir, 'validation_data.npy'), mmap_mode='r')
+        assert out['time'].dtype == np.float64
+        assert np.all(out['time'] == times)
+        for msid in pred:
+            for name in ('tlm_', 'pred_', 'resid_'):
+                assert out[name + msid].dtype == np.float32, name + msid
+        del out
+    finally:
+        shutil.rmtree(opt.outdir)
+
+
+def test_compact_resid_stats():
+    for exact in (False, True):
+        T64 = twodof.calc_twodof_model(states, pin0, dea0, times, char.model_par,
+                                       exact=exact)
+        T32 = twodof.calc_twodof_model(states, pin0, dea0, times, char.model_par,
+                                       exact=exact, out_dtype='f4')
+        for i, (t64, t32) in enumerate(zip(T64, T32)):
+            tlm64 = fake_telem(t64, seed=i)
+            tlm32 = tlm64.astype(np.float32)
+            stats64 = resid_stats(tlm64 - t64)
+            stats32 = resid_stats(tlm32 - t32)
+            assert np.all(np.abs(stats64 - stats32) < 0.001)
+
+
+if __name__ == '__main__':
+    test_get_telem_values_dtype()
+    test_validation_dtype()
+    test_validation_data_dtype()
+    test_compact_resid_stats()
+    print('OK')
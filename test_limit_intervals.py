@@ -0,0 +1,76 @@
+"""
+Check that twodof.calc_limit_intervals finds the same planning, yellow and
+red limit violation intervals as thresholding the model evaluated exactly on
+a dense (1 sec) time grid.
+"""
+import numpy as np
+import twodof
+import characteristics as char
+
+dt = 1.0
+limits = {'1pdeaat': (char.T_dea_yellow - char.T_dea_margin,
+                      char.T_dea_yellow, char.T_dea_red),
+          '1pin1at': (char.T_pin_yellow - char.T_pin_margin,
+                      char.T_pin_yellow, char.T_pin_red)}
+
+
+def make_states(n_states, seed):
+    """Hot schedule of ``n_states`` random states, a quarter of them 10 sec
+    long, starting at time 0."""
+    rand = np.random.RandomState(seed)
+    durs = np.where(rand.uniform(size=n_states) < 0.25, 10.,
+                    rand.uniform(1000., 40000., n_states))
+    tstops = np.cumsum(durs)
+    tstarts = np.concatenate([[0.], tstops[:-1]])
+    return np.rec.fromarrays([tstarts, tstops,
+                              rand.uniform(100., 260., n_states),
+                              rand.uniform(46., 170., n_states),
+                              rand.choice([-99616., -50504., 75624., 92904.], n_states)],
+                             names=['tstart', 'tstop', 'power', 'pitch', 'simpos'])
+
+
+def check_intervals(states, T_pin0, T_dea0):
+    times = np.arange(states[0]['tstart'], states[-1]['tstop'], dt)
+    T_pin, T_dea = twodof.calc_twodof_model(states, T_pin0, T_dea0, times,
+                                            char.model_par, exact=True)
+    temps = {'1pin1at': T_pin, '1pdeaat': T_dea}
+    n_intervals = {}
+    for msid in sorted(limits):
+        intervals = twodof.calc_limit_intervals(states, T_pin0, T_dea0, char.model_par,
+                                                limits[msid], msid=msid)
+        for limit, rows in zip(limits[msid], intervals):
+            temp = temps[msid]
+            bad = np.concatenate(([False], temp >= limit, [False]))
+            changes = np.flatnonzero(bad[1:] != bad[:-1]).reshape(-1, 2)
+            assert len(changes) == len(rows), (msid, limit, len(changes), len(rows))
+            for row, (i0, i1) in zip(rows, changes):
+                assert abs(row['tstart'] - times[i0]) <= dt
+                assert abs(row['tstop'] - times[i1 - 1]) <= dt
+                assert row['maxtemp'] >= temp[i0:i1].max() - 1e-9
+                assert row['maxtemp'] < temp[i0:i1].max() + 0.01
+            n_intervals[msid, limit] = len(rows)
+    return n_intervals
+
+
+def test_limit_intervals():
+    states = make_states(60, seed=3)
+    n_intervals = check_intervals(states, 30., 40.)
+    # Crossings of every 1PDEAAT limit are exercised
+    for limit in limits['1pdeaat']:
+        assert n_intervals['1pdeaat', limit] > 0
+
+
+def test_limit_intervals_start_above():
+    states = make_states(60, seed=2)
+    T_dea0 = char.T_dea_red + 1.0
+    T_pin0 = char.T_pin_yellow + 1.0
+    for rows in twodof.calc_limit_intervals(states, T_pin0, T_dea0, char.model_par,
+                                            limits['1pdeaat'], msid='1pdeaat'):
+        assert rows[0]['tstart'] == states[0]['tstart']
+    check_intervals(states, T_pin0, T_dea0)
+
+
+if __name__ == '__main__':
+    test_limit_intervals()
+    test_limit_intervals_start_above()
+    print('OK')
@@ -0,0 +1,148 @@
+"""
+Check that the vectorized model kernel matches the original per-state
+eigen-decomposition and ``calc_state_temps`` loop to floating-point
+tolerance, for both ``calc_twodof_model`` and ``TwoDOF.calc_model``.
+
+The reference functions below are copied from the original twodof.py.  The
+original ``Tf_zero_power`` interpolates float32 settling temperatures, which
+gives differences of a few 1e-6 degC.
+"""
+import numpy as np
+import Ska.Numpy
+import twodof
+import characteristics as char
+
+CtoK = 273.15
+KtoC = -CtoK
+ATOL = 1e-4                     # degC
+
+
+def ref_Tf_zero_power(par, pitch, simz):
+    U01 = par['u01'] + par['u01quad'] * ((pitch-110.)/60)**2
+    U12 = par['u12']
+
+    if simz < -85000:          # HRC-S
+        det = 'hrcs'
+    elif simz < 0:
+        det = 'hrci'
+    else:
+        det = 'acis'
+
+    pitchs = np.array([50., 90., 150.])
+    tfzps = np.array([par[det + '50'],
+                      par[det + '90'],
+                      par[det + '150']], dtype='float32')
+
+    Pp = 128
+    T2 = Ska.Numpy.interpolate(tfzps, pitchs, [pitch])[0]
+
+    return T2 - Pp * (1./U01 + 1./U12) + CtoK
+
+
+def ref_calc_state_temps(state, par, t, Ti, eigvals, eigvecs, eigvecinvs, U01, C1, C2):
+    Tf_zp = ref_Tf_zero_power(par, state['pitch'], state['simpos'])
+
+    heat = np.array([[U01 * (Tf_zp / C1)],
+                     [state['power'] / C2]])
+    l1 = eigvals[0]
+    l2 = eigvals[1]
+
+    t_ksec = t / 1000.
+    exp_l1_t = np.exp(l1*t_ksec)
+    exp_l2_t = np.exp(l2*t_ksec)
+
+    lenM = len(t) * 2 * 2
+    M1 = np.zeros(lenM)
+    M1[0:lenM:4] = (exp_l1_t-1)/l1
+    M1[3:lenM:4] = (exp_l2_t-1)/l2
+    M1 = M1.reshape(len(t), 2, 2)
+    T1 = np.dot(np.dot(M1, eigvecinvs), heat)
+
+    M2 = np.zeros(lenM)
+    M2[0:lenM:4] = exp_l1_t
+    M2[3:lenM:4] = exp_l2_t
+    M2 = M2.reshape(len(t), 2, 2)
+    T2 = np.dot(np.dot(M2, eigvecinvs), Ti)
+
+    return np.dot(eigvecs, (T1 + T2)).reshape(2, -1)
+
+
+def ref_calc_twodof_model(states, T_pin0, T_dea0, times, par, dt=32.8):
+    predTs = []
+    tvals = []
+    Ti = np.array([[T_pin0],
+                   [T_dea0]]) + CtoK
+
+    for state in states:
+        U01 = par['u01'] + par['u01quad'] * ((state['pitch']-110.)/60)**2
+        U12 = par['u12']
+        C1 = par['c1']
+        C2 = par['c2']
+
+        M = np.array([[-(U01 + U12) / C1,  U12 / C1],
+                      [U12 / C2,          -U12 / C2]])
+        eigvals, eigvecs = np.linalg.eig(M)
+        eigvecinvs = np.linalg.inv(eigvecs)
+
+        t0 = state['tstart']
+        n_t = int((state['tstop'] - state['tstart']) / dt)
+        tval = np.linspace(state['tstart'], state['tstop'], n_t+2)
+
+        predT = ref_calc_state_temps(state, par, tval - t0, Ti,
+                                     eigvals, eigvecs, eigvecinvs,
+                                     U01, C1, C2)
+        tvals.append(tval)
+        predTs.append(predT)
+
+        Ti = predT[:, -1].reshape(2, 1)
+
+    tval = np.hstack(tvals)
+    predT = np.hstack(predTs)
+    T_pin = Ska.Numpy.interpolate(predT[0, :] + KtoC, tval, times)
+    T_dea = Ska.Numpy.interpolate(predT[1, :] + KtoC, tval, times)
+
+    return T_pin, T_dea
+
+
+def make_states(n_states, seed):
+    """Random schedule of ``n_states`` states starting at time 0."""
+    rand = np.random.RandomState(seed)
+    durs = rand.uniform(100., 40000., n_states)
+    tstops = np.cumsum(durs)
+    tstarts = np.concatenate([[0.], tstops[:-1]])
+    return np.rec.fromarrays([tstarts, tstops,
+                              rand.uniform(40., 140., n_states),
+                              rand.uniform(46., 170., n_states),
+                              rand.choice([-99616., -50504., 75624., 92904.], n_states)],
+                             names=['tstart', 'tstop', 'power', 'pitch', 'simpos'])
+
+
+states = make_states(300, 1)
+pin0 = 35.
+dea0 = 25.
+times = np.linspace(states[0]['tstart'], states[-1]['tstop'], 20000)
+
+
+def test_calc_twodof_model():
+    ref_pin, ref_dea = ref_calc_twodof_model(states, pin0, dea0, times, char.model_par)
+    T_pin, T_dea = twodof.calc_twodof_model(states, pin0, dea0, times, char.model_par)
+    assert np.allclose(T_pin, ref_pin, rtol=0, atol=ATOL)
+    assert np.allclose(T_dea, ref_dea, rtol=0, atol=ATOL)
+
+
+def test_calc_twodof_model_exact():
+    ref_pin, ref_dea = ref_calc_twodof_model(states, pin0, dea0, times, char.model_par)
+    T_pin, T_dea = twodof.calc_twodof_model(states, pin0, dea0, times, char.model_par,
+                                            exact=True)
+    # The reference interpolates linearly on a 32.8 sec grid
+    assert np.allclose(T_pin, ref_pin, rtol=0, atol=0.01)
+    assert np.allclose(T_dea, ref_dea, rtol=0, atol=0.01)
+
+
+def test_twodof_calc_model():
+    ref_pin, ref_dea = ref_calc_twodof_model(states, pin0, dea0, times, char.model_par)
+    model = twodof.TwoDOF(states, pin0, dea0)
+    assert np.allclose(model.calc_model(times, char.model_par, msid='1pin1at'), ref_pin,
+                       rtol=0, atol=ATOL)
+    assert np.allclose(model.calc_model(times, char.model_par, msid='1pdeaat'), ref_dea,
+                       rtol=0, atol=ATOL)
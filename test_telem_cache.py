@@ -0,0 +1,48 @@
+"""
+Check that psmc_check.get_telem_values gives the same telemetry values from
+the on-disk cache as directly from the engineering archive on the same time
+grid.  Bad quality samples must be filtered in both cases.
+"""
+import shutil
+import tempfile
+import numpy as np
+import psmc_check
+import telem_cache
+
+msids = ['1pdeaat', '1pin1at', 'sim_z', 'aosares1', '1de28avo', '1deicacu']
+tstart = '2010:100:12:00:00.000'
+days = 3.5
+dt = 32.8
+
+
+def check_same(cached, direct):
+    # Both grids are k * dt so match samples by grid index k
+    k_cached = np.round(cached['date'] / dt).astype(int)
+    k_direct = np.round(direct['date'] / dt).astype(int)
+    k = np.intersect1d(k_cached, k_direct)
+    assert len(k) > 0.99 * min(len(cached), len(direct))
+    i_cached = np.searchsorted(k_cached, k)
+    i_direct = np.searchsorted(k_direct, k)
+    assert np.allclose(cached['date'][i_cached], direct['date'][i_direct])
+    for msid in msids:
+        assert np.all(cached[msid][i_cached] == direct[msid][i_direct]), msid
+
+
+def test_cache_matches_archive():
+    cache_dir = tempfile.mkdtemp()
+    try:
+        cache = telem_cache.TelemCache(cache_dir)
+        direct = psmc_check.get_telem_values(tstart, msids, days=days, dt=dt)
+
+        # First call fetches and fills the cache, second reads the cache
+        for i in range(2):
+            cached = psmc_check.get_telem_values(tstart, msids, days=days, dt=dt,
+                                                 cache=cache)
+            check_same(cached, direct)
+    finally:
+        shutil.rmtree(cache_dir)
+
+
+if __name__ == '__main__':
+    test_cache_matches_archive()
+    print('OK')
@@ -2,94 +2,537 @@
 Calculate ACIS PSMC temperatures using a two degree-of-freedom model.
 """
 
+import os
+import json
+import hashlib
+import tempfile
+import multiprocessing
 import numpy as np
-import math
+from collections import OrderedDict, namedtuple
 
 import pkg_resources
 pkg_resources.require('Ska.Numpy')
 import Ska.Numpy
 
+import characteristics
+
 # Define a number of module constants that are tuned.
 
 CtoK = 273.15
 KtoC = -CtoK
 
+# Model parameter names.  Arrays of parameter sets use this column order.
+PARNAMES = sorted(characteristics.model_par)
+
+# Model parameters that define the two-mass model matrix (in addition to pitch)
+EIGSYS_PARNAMES = ('u01', 'u01quad', 'u12', 'c1', 'c2')
+
+class LRUCache(object):
+    """Bounded least-recently-used cache with hit / miss counters.
+
+    :param maxsize: maximum number of entries to keep
+    """
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        """Return cached value for ``key`` (marking it as most recently used)
+        or ``default`` if ``key`` is not in the cache."""
+        try:
+            val = self.data.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        self.data[key] = val
+        self.hits += 1
+        return val
+
+    def set(self, key, val):
+        """Store ``val`` for ``key``, evicting the least recently used entries
+        if the cache is full."""
+        self.data.pop(key, None)
+        self.data[key] = val
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def clear(self):
+        """Remove all entries and reset the counters."""
+        self.data.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        """Return a dict of cache statistics suitable for logging."""
+        return dict(size=len(self.data), maxsize=self.maxsize,
+                    hits=self.hits, misses=self.misses)
+
+    def __len__(self):
+        return len(self.data)
+
+# Eigensystem arrays keyed by (u01, u01quad, u12, c1, c2, pitch shape, pitch digest)
+eigsys_cache = LRUCache(maxsize=64)
+
+def as_float32(val):
+    """Round ``val`` to float32 precision.  For complex values only the real
+    part is rounded so that complex-step derivatives pass through unchanged.
+    """
+    val = np.asarray(val)
+    if np.iscomplexobj(val):
+        return val.real.astype('float32') + 1j * val.imag
+    return val.astype('float32')
+
 def Tf_zero_power(par, pitch, simz):
     """Settling temperature (Tf) at zero PSMC power.
     The corresponds to the T0 parameter of the two-mass model.
+
+    The ``pitch`` and ``simz`` inputs can be scalars or arrays (e.g. the
+    ``pitch`` and ``simpos`` columns of a states recarray).  For arrays the
+    detector for each element is classified with boolean masks and the pitch
+    interpolation weights are computed for all elements of each detector at
+    once.  The ``par`` values can also be arrays that broadcast against
+    ``pitch`` (e.g. shape (N, 1) for N parameter sets).
+
+    :param par: model parameters dictionary
+    :param pitch: pitch (deg)
+    :param simz: SIM-Z position (steps)
+
+    :rtype: settling temperature (degK), scalar or array matching inputs
     """
+    pitch = np.asarray(pitch, dtype=float)
+    simz = np.asarray(simz, dtype=float)
+    pitch, simz = np.broadcast_arrays(pitch, simz)
+
     U01 = par['u01'] + par['u01quad'] * ((pitch-110.)/60)**2
     U12 = par['u12']
 
-    if simz < -85000:          # HRC-S
-        det = 'hrcs'
-    elif simz < 0:
-        det = 'hrci'
-    else:
-        det = 'acis'
-        
+    hrcs = simz < -85000          # HRC-S
+    hrci = ~hrcs & (simz < 0)
+    acis = simz >= 0
+
     pitchs = np.array([50., 90., 150.])
-    tfzps = np.array([par[det + '50'],
-                      par[det + '90'],
-                      par[det + '150']], dtype='float32')
+    T2 = np.zeros(np.shape(U01), dtype=np.result_type(float, *par.values()))
+    for det, mask in (('hrcs', hrcs), ('hrci', hrci), ('acis', acis)):
+        if np.any(mask):
+            tfzps = [as_float32(par[det + x]) for x in ('50', '90', '150')]
+            # T2 is linear in the settling temperatures so interpolate the
+            # weight of each of the three pitch nodes.
+            weights = [Ska.Numpy.interpolate(node, pitchs, pitch[mask])
+                       for node in np.eye(3)]
+            T2[..., mask] = sum(tfzp * weight for tfzp, weight in zip(tfzps, weights))
 
     # Zero power temp T0 = T2 - Pp(1/U01 + 1/U12)
     Pp = 128                    # For 6 chips => Pp = 128
-    T2 = Ska.Numpy.interpolate(tfzps, pitchs, [pitch])[0]
-
-    return T2 - Pp * (1./U01 + 1./U12) + CtoK
-
-def calc_state_temps(state, par, t, Ti, eigvals, eigvecs, eigvecinvs, U01, C1, C2):
-    """Calculate predicted temperatures at the input times for a given state
-    using the two-mass model.
-
-    Evaluate the following but do so in a vectorized form::
-
-      exp_l1_t = math.exp(l1*t)
-      exp_l2_t = math.exp(l2*t)
-      T1 = np.matrix([[(exp_l1_t-1)/l1, 0 ],
-                      [0, (exp_l2_t-1)/l2]]) * self.eigvecinvs * self.heat
-      T2 = np.matrix([[exp_l1_t, 0  ],
-                      [0,  exp_l2_t]]) * self.eigvecinvs * self.Ti
-      return self.eigvecs * (T1 + T2)
-
-    :param state: state vector (with power, pitch, simpos)
-    :param par: model parameter values
-    :param t: numpy array of input times (sec)
-    :param Ti: Vector of initial temperatures (1pin1at and 1pdeaat)
-
-    :rtype: numpy array of temperatures at times C{t}
-    """
-    # Model settling temperature at zero power for given pitch and sim-z
-    Tf_zp = Tf_zero_power(par, state['pitch'], state['simpos'])
-    
-    heat = np.array([[U01 * (Tf_zp / C1)],
-                     [state['power'] / C2]])
-    l1 = eigvals[0]
-    l2 = eigvals[1]
-    Ti = Ti
-
-    t_ksec = t / 1000.
-    exp_l1_t = np.exp(l1*t_ksec)
-    exp_l2_t = np.exp(l2*t_ksec)
-
-    lenM = len(t) * 2 * 2
-    M1 = np.zeros(lenM)
-    M1[0:lenM:4] = (exp_l1_t-1)/l1
-    M1[3:lenM:4] = (exp_l2_t-1)/l2
-    M1 = M1.reshape(len(t), 2, 2)
-    T1 = np.dot(np.dot(M1, eigvecinvs), heat)
-
-    M2 = np.zeros(lenM)
-    M2[0:lenM:4] = exp_l1_t
-    M2[3:lenM:4] = exp_l2_t
-    M2 = M2.reshape(len(t), 2, 2)
-    T2 = np.dot(np.dot(M2, eigvecinvs), Ti)
-
-    return np.dot(eigvecs, (T1 + T2)).reshape(2, -1)
+    Tf = T2 - Pp * (1./U01 + 1./U12) + CtoK
+
+    return Tf if Tf.ndim > 0 else Tf[()]
+
+def calc_settling_map(par, pitch, simz, power=None):
+    """Calculate the equilibrium (settling) temperatures of 1PIN1AT and
+    1PDEAAT on a full grid of ``pitch`` x ``simz`` x ``power`` values.
+
+    Setting dT/dt = 0 in the two-mass model gives the closed form::
+
+      T_pin = Tf + P / U01
+      T_dea = T_pin + P / U12
+
+    where Tf is the zero-power settling temperature from ``Tf_zero_power()``
+    so the whole grid is computed in one vectorized pass.
+
+    :param par: model parameters dictionary
+    :param pitch: pitch values (deg)
+    :param simz: SIM-Z position values (steps)
+    :param power: PSMC power values (watts), default=power for each row of
+                  ``characteristics.psmc_power`` in table order
+
+    :rtype: settling temperature arrays (T_pin, T_dea) in degC, each with
+            shape (len(pitch), len(simz), len(power))
+    """
+    if power is None:
+        power = [row[3] for row in characteristics.psmc_power]
+    pitch = np.asarray(pitch, dtype=float).reshape(-1, 1, 1)
+    simz = np.asarray(simz, dtype=float).reshape(1, -1, 1)
+    power = np.asarray(power, dtype=float).reshape(1, 1, -1)
+
+    U01 = par['u01'] + par['u01quad'] * ((pitch - 110.) / 60.)**2
+    Tf = Tf_zero_power(par, pitch, simz)
+    T_pin = Tf + power / U01 + KtoC
+    T_dea = T_pin + power / par['u12']
+
+    return T_pin, T_dea
+
+def calc_eigsys(U01, U12, C1, C2):
+    """Calculate the eigen-decomposition of the two-mass model matrix::
+
+      M = [[-(U01 + U12) / C1,  U12 / C1],
+           [U12 / C2,          -U12 / C2]]
+
+    for any number of states at once using the analytic 2x2 formulas.  The
+    inputs can be scalars or arrays that broadcast against each other (e.g. an
+    array of ``U01`` values, one per state).  The results are equivalent to
+    ``np.linalg.eig(M)`` and ``np.linalg.inv(eigvecs)`` for each element.
+
+    :param U01: conductance between 1PIN1AT and SIM external
+    :param U12: conductance between 1PIN1AT and 1PDEAAT
+    :param C1: heat capacitance for 1PIN1AT
+    :param C2: heat capacitance for 1PDEAAT
+
+    :rtype: eigvals[..., 2], eigvecs[..., 2, 2], eigvecinvs[..., 2, 2]
+    """
+    a = -(U01 + U12) / C1
+    b = U12 / C1
+    c = U12 / C2
+    d = -U12 / C2
+
+    # Both eigenvalues are real and negative since b * c > 0.  Get the larger
+    # magnitude one directly and the other from the determinant to avoid
+    # cancellation.
+    half_tr = (a + d) / 2.
+    disc = np.sqrt(((a - d) / 2.)**2 + b * c)
+    l2 = half_tr - disc
+    l1 = (a * d - b * c) / l2
+
+    # Eigenvector for eigenvalue l is (b, l - a), and the inverse of the
+    # eigenvector matrix follows from the 2x2 adjugate.
+    v21 = l1 - a
+    v22 = l2 - a
+    det = b * (v22 - v21)
+
+    eigvals = np.array(np.broadcast_arrays(l1, l2))
+    eigvecs = np.array(np.broadcast_arrays(b, b, v21, v22))
+    eigvecinvs = np.array(np.broadcast_arrays(v22 / det, -b / det,
+                                              -v21 / det, b / det))
+
+    shape = eigvals.shape[1:]
+    eigvals = np.rollaxis(eigvals, 0, len(shape) + 1)
+    eigvecs = np.rollaxis(eigvecs, 0, len(shape) + 1).reshape(shape + (2, 2))
+    eigvecinvs = np.rollaxis(eigvecinvs, 0, len(shape) + 1).reshape(shape + (2, 2))
+
+    return eigvals, eigvecs, eigvecinvs
+
+def get_eigsys(par, pitch):
+    """Return the two-mass model eigensystem for each of ``pitch`` using
+    ``eigsys_cache``.  The cache holds the whole result arrays for a given
+    ``u01``, ``u01quad``, ``u12``, ``c1`` and ``c2`` and pitch array (keyed by
+    a digest of the pitch values) so a hit costs one hash of ``pitch`` and a
+    miss one vectorized ``calc_eigsys()`` call.  The returned arrays are
+    read-only since they may be shared with other callers.
+
+    :param par: model parameters dictionary
+    :param pitch: array of pitch values (deg)
+
+    :rtype: eigvals[n, 2], eigvecs[n, 2, 2], eigvecinvs[n, 2, 2]
+    """
+    pitch = np.ascontiguousarray(pitch, dtype=float)
+    key = (tuple(float(par[x]) for x in EIGSYS_PARNAMES)
+           + (pitch.shape, hashlib.sha1(pitch).hexdigest()))
+
+    eigsys = eigsys_cache.get(key)
+    if eigsys is None:
+        U01s = par['u01'] + par['u01quad'] * ((pitch - 110.) / 60.)**2
+        eigsys = calc_eigsys(U01s, par['u12'], par['c1'], par['c2'])
+        for arr in eigsys:
+            arr.flags.writeable = False
+        eigsys_cache.set(key, eigsys)
+
+    return eigsys
+
+def get_state_arrays(states):
+    """Return a dict of float arrays for the ``tstart``, ``tstop``, ``power``,
+    ``pitch`` and ``simpos`` values of ``states``.  Columns of a structured
+    array or recarray are converted directly, otherwise (e.g. a list of
+    dicts) the values are collected row by row."""
+    cols = ('tstart', 'tstop', 'power', 'pitch', 'simpos')
+    if getattr(getattr(states, 'dtype', None), 'names', None):
+        return dict((col, np.asarray(states[col], dtype=float)) for col in cols)
+    return dict((col, np.array([state[col] for state in states], dtype=float))
+                for col in cols)
+
+def calc_state_maps(eigvals, eigvecs, eigvecinvs, heat, tau):
+    """Calculate the steady-state temperatures and the affine map ``T_end = A
+    * T_start + b`` that takes the node temperatures across each state.  All
+    inputs can have arbitrary leading dimensions (e.g. parameter set, state).
+
+    :param eigvals: eigenvalues [..., 2]
+    :param eigvecs: eigenvectors [..., 2, 2]
+    :param eigvecinvs: inverse of eigenvector matrix [..., 2, 2]
+    :param heat: heat input vector [..., 2]
+    :param tau: state duration (ksec)
+
+    :rtype: y_ss[..., 2], T_ss[..., 2], A[..., 2, 2], b[..., 2]
+    """
+    # Steady-state temperatures in the eigenvector basis and node temperatures
+    y_ss = -np.sum(eigvecinvs * heat[..., np.newaxis, :], axis=-1) / eigvals
+    T_ss = np.sum(eigvecs * y_ss[..., np.newaxis, :], axis=-1)
+
+    exp_tau = np.exp(eigvals * np.asarray(tau)[..., np.newaxis])
+    A = np.sum((eigvecs * exp_tau[..., np.newaxis, :])[..., np.newaxis]
+               * eigvecinvs[..., np.newaxis, :, :], axis=-2)
+    b = T_ss - np.sum(A * T_ss[..., np.newaxis, :], axis=-1)
+
+    return y_ss, T_ss, A, b
+
+def propagate_states(A, b, Ti):
+    """Propagate node temperatures ``Ti`` through the sequence of state affine
+    maps ``T_end = A * T_start + b`` (state axis is the second to last axis of
+    ``b``).
+
+    :param A: affine map matrices [..., n_states, 2, 2]
+    :param b: affine map offsets [..., n_states, 2]
+    :param Ti: initial node temperatures [..., 2]
+
+    :rtype: node temperatures at the start of each state [..., n_states, 2]
+    """
+    T_start = np.empty(b.shape, dtype=np.result_type(b, Ti))
+
+    if b.ndim == 2:
+        # Single parameter set: plain float recurrence is fastest
+        T0, T1 = np.asarray(Ti).reshape(2).tolist()
+        for i, (a00, a01, a10, a11, b0, b1) in enumerate(
+                zip(A[:, 0, 0].tolist(), A[:, 0, 1].tolist(),
+                    A[:, 1, 0].tolist(), A[:, 1, 1].tolist(),
+                    b[:, 0].tolist(), b[:, 1].tolist())):
+            T_start[i] = T0, T1
+            T0, T1 = a00 * T0 + a01 * T1 + b0, a10 * T0 + a11 * T1 + b1
+    else:
+        T = np.array(Ti, dtype=T_start.dtype)
+        for i in range(b.shape[-2]):
+            T_start[..., i, :] = T
+            T = np.sum(A[..., i, :, :] * T[..., np.newaxis, :], axis=-1) + b[..., i, :]
+
+    return T_start
+
+def calc_state_coeffs(states, Ti, par):
+    """Calculate the closed-form solution coefficients of the two-mass model
+    for every state in ``states``, starting from node temperatures ``Ti``.
+
+    Within state ``i`` the node temperatures (degK) are a sum of two
+    exponentials::
+
+      T[n](t) = T_ss[i, n] + amps[i, n, 0] * exp(eigvals[i, 0] * (t - tstart[i]) / 1000)
+                           + amps[i, n, 1] * exp(eigvals[i, 1] * (t - tstart[i]) / 1000)
+
+    where ``n`` = 0 (1pin1at) or 1 (1pdeaat).  The eigen-decomposition for all
+    states comes from ``get_eigsys()`` and the node temperatures at the state
+    boundaries are then found with a cheap scalar recurrence.
+
+    If the ``par`` values are arrays of shape (N, 1) (see ``get_batch_par()``)
+    then the coefficients are calculated for N parameter sets at once and each
+    coefficient array gets a leading axis of length N.  In this case ``Ti`` is
+    an (N, 2) array.
+
+    :param states: iterable list of states (must be contiguous)
+    :param Ti: initial temperatures (degK) as a 2x1 array (1pin1at, 1pdeaat)
+    :param par: model parameters dictionary
+
+    :rtype: dict of coefficient arrays (tstart, tstop, eigvals, T_ss, amps, T_start)
+    """
+    maps = get_state_maps(states, par)
+    if np.ndim(par['u01']) == 0:
+        Ti = np.asarray(Ti).reshape(2)
+    T_start = propagate_states(maps['A'], maps['b'], Ti)
+
+    y_start = np.sum(maps['eigvecinvs'] * T_start[..., np.newaxis, :], axis=-1)
+    amps = maps['eigvecs'] * (y_start - maps['y_ss'])[..., np.newaxis, :]
+
+    return dict(tstart=maps['tstart'], tstop=maps['tstop'], eigvals=maps['eigvals'],
+                T_ss=maps['T_ss'], amps=amps, T_start=T_start)
+
+def get_state_maps(states, par):
+    """Calculate the eigen-decomposition, steady-state temperatures and affine
+    map ``T_end = A * T_start + b`` for every state in ``states``.  These do
+    not depend on the initial temperatures.  As for ``calc_state_coeffs()``
+    the ``par`` values can be (N, 1) arrays for N parameter sets.
+
+    :param states: iterable list of states (must be contiguous)
+    :param par: model parameters dictionary
+
+    :rtype: dict of arrays (tstart, tstop, eigvals, eigvecs, eigvecinvs, y_ss, T_ss, A, b)
+    """
+    cols = get_state_arrays(states)
+    tstart = cols['tstart']
+    tstop = cols['tstop']
+    pitch = cols['pitch']
+
+    U01s = par['u01'] + par['u01quad'] * ((pitch - 110.) / 60.)**2
+    C1 = par['c1']
+    C2 = par['c2']
+    if np.ndim(par['u01']) == 0:
+        eigvals, eigvecs, eigvecinvs = get_eigsys(par, pitch)
+    else:
+        eigvals, eigvecs, eigvecinvs = calc_eigsys(U01s, par['u12'], C1, C2)
+
+    Tf_zp = Tf_zero_power(par, pitch, cols['simpos'])
+    heat = np.array(np.broadcast_arrays(U01s * (Tf_zp / C1),
+                                        cols['power'] / C2))
+    heat = np.rollaxis(heat, 0, heat.ndim)
+
+    y_ss, T_ss, A, b = calc_state_maps(eigvals, eigvecs, eigvecinvs, heat,
+                                       (tstop - tstart) / 1000.)
+
+    return dict(tstart=tstart, tstop=tstop, eigvals=eigvals, eigvecs=eigvecs,
+                eigvecinvs=eigvecinvs, y_ss=y_ss, T_ss=T_ss, A=A, b=b)
+
+def compose_state_maps(A, b):
+    """Compose the sequence of state affine maps ``T_end = A[i] * T_start +
+    b[i]`` for a single parameter set into one map for the whole sequence.
+
+    :param A: affine map matrices [n_states, 2, 2]
+    :param b: affine map offsets [n_states, 2]
+
+    :rtype: A_tot[2, 2], b_tot[2]
+    """
+    A_tot = np.eye(2)
+    b_tot = np.zeros(2)
+    for A_i, b_i in zip(A, b):
+        A_tot = np.dot(A_i, A_tot)
+        b_tot = np.dot(A_i, b_tot) + b_i
+
+    return A_tot, b_tot
+
+def eval_state_coeffs(coeffs, t, idx):
+    """Evaluate the closed-form model solution at times ``t`` where each time
+    falls in the state with index ``idx`` (same length as ``t``).  All samples
+    for all states are evaluated in one vectorized pass.
+
+    :param coeffs: state coefficients from ``calc_state_coeffs()``
+    :param t: array of times (secs)
+    :param idx: array of state indexes for each time in ``t``
+
+    :rtype: predT[2, len(t)] (degK), or predT[2, N, len(t)] for N parameter sets
+    """
+    dt_ksec = (t - coeffs['tstart'].take(idx)) / 1000.
+    eigvals = coeffs['eigvals']
+    T_ss = coeffs['T_ss']
+    amps = coeffs['amps']
+
+    # For multiple parameter sets evaluate one set at a time so that the
+    # temporaries stay the size of ``t``.
+    lead_shape = T_ss.shape[:-2]
+    n_lead = int(np.prod(lead_shape))
+    eigvals = eigvals.reshape((n_lead,) + eigvals.shape[-2:])
+    T_ss = T_ss.reshape((n_lead,) + T_ss.shape[-2:])
+    amps = amps.reshape((n_lead,) + amps.shape[-3:])
+
+    predT = np.empty((2, n_lead, len(dt_ksec)), dtype=np.result_type(eigvals, amps))
+    for i in range(n_lead):
+        exp_l1_t = np.exp(eigvals[i, :, 0].take(idx) * dt_ksec)
+        exp_l2_t = np.exp(eigvals[i, :, 1].take(idx) * dt_ksec)
+        for node in (0, 1):
+            out = predT[node, i]
+            out[:] = T_ss[i, :, node].take(idx)
+            out += amps[i, :, node, 0].take(idx) * exp_l1_t
+            out += amps[i, :, node, 1].take(idx) * exp_l2_t
+
+    return predT.reshape((2,) + lead_shape + (len(dt_ksec),))
+
+def get_grid(tstart, tstop, dt=32.8):
+    """Make the concatenated grid of model evaluation times for states with
+    start and stop times ``tstart`` and ``tstop``.
+
+    The grid for each state is ``np.linspace(tstart, tstop, n_t + 2)`` with
+    ``n_t = int((tstop - tstart) / dt)``, so the boundary times appear twice.
+
+    :param tstart: array of state start times (secs)
+    :param tstop: array of state stop times (secs)
+    :param dt: approximate time spacing for calculating model values (secs)
+
+    :rtype: tval, idx (state index for each grid time)
+    """
+    n_ts = ((tstop - tstart) / dt).astype(int) + 2
+    idx = np.repeat(np.arange(len(n_ts)), n_ts)
+    i0s = np.cumsum(n_ts) - n_ts
+    steps = (tstop - tstart) / (n_ts - 1)
+    tval = tstart[idx] + (np.arange(len(idx)) - i0s[idx]) * steps[idx]
+    tval[i0s + n_ts - 1] = tstop
+
+    return tval, idx
+
+def calc_model_grid(states, Ti, par, dt=32.8):
+    """Propagate the two-mass model through ``states`` starting from the node
+    temperatures ``Ti`` (degK), evaluating each state on a grid of times with
+    approximate spacing ``dt`` (see ``get_grid()``).
+
+    :param states: iterable list of states (must be contiguous)
+    :param Ti: initial temperatures (degK) as a 2x1 array (1pin1at, 1pdeaat)
+    :param par: model parameters dictionary
+    :param dt: approximate time spacing for calculating model values (secs)
+
+    :rtype: tval, predT[2, len(tval)] (degK)
+    """
+    coeffs = calc_state_coeffs(states, Ti, par)
+    tval, idx = get_grid(coeffs['tstart'], coeffs['tstop'], dt)
+
+    return tval, eval_state_coeffs(coeffs, tval, idx)
+
+def calc_model_exact(states, Ti, par, times):
+    """Propagate the two-mass model through ``states`` starting from the node
+    temperatures ``Ti`` (degK) and evaluate the closed-form solution directly
+    at ``times``.  Each time is located in the state table with a
+    searchsorted index so no intermediate time grid or interpolation is
+    needed.  Times outside the span of ``states`` are clipped to the span
+    (as for interpolation).
+
+    :param states: iterable list of states (must be contiguous)
+    :param Ti: initial temperatures (degK) as a 2x1 array (1pin1at, 1pdeaat)
+    :param par: model parameters dictionary
+    :param times: array of times at which to evaluate the model (secs)
+
+    :rtype: predT[2, len(times)] (degK)
+    """
+    coeffs = calc_state_coeffs(states, Ti, par)
+    times = np.clip(np.asarray(times, dtype=float),
+                    coeffs['tstart'][0], coeffs['tstop'][-1])
+    idx = get_state_index(coeffs['tstart'], times)
+
+    return eval_state_coeffs(coeffs, times, idx)
+
+def get_state_index(tstart, times):
+    """Return the index of the state containing each of ``times`` given the
+    sorted state start times ``tstart``.  Times before the first state map to
+    the first state.
+    """
+    idx = np.searchsorted(tstart, times, side='right') - 1
+    return np.clip(idx, 0, len(tstart) - 1)
+
+class ModelPar(namedtuple('ModelPar', PARNAMES)):
+    """Immutable and hashable model parameters, with one field for each name in
+    ``PARNAMES``.  Values can also be accessed by name as for a model
+    parameters dictionary (``par['u01']``) so a ``ModelPar`` can be used
+    anywhere a parameters dictionary is expected, and as a cache key.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_par(cls, par):
+        """Make a ModelPar from model parameters dictionary ``par``."""
+        if isinstance(par, cls):
+            return par
+        return cls(*[float(par[name]) for name in PARNAMES])
+
+    def __getitem__(self, key):
+        if isinstance(key, basestring):
+            return getattr(self, key)
+        return tuple.__getitem__(self, key)
+
+    def keys(self):
+        return list(self._fields)
+
+    def values(self):
+        return list(self)
+
+    def items(self):
+        return list(zip(self._fields, self))
+
+def get_times_key(t):
+    """Return a hashable key identifying the values in the times array ``t``."""
+    t = np.ascontiguousarray(t, dtype=float)
+    return (len(t), hashlib.md5(t).hexdigest())
 
 class TwoDOF(object):
-    def __init__(self, states, T_pin0, T_dea0, dt=32.8):
+    def __init__(self, states, T_pin0, T_dea0, dt=32.8, exact=False, cache_size=8):
         """Initialize model object to predict the PSMC temperatures 1PDEAAT and
         1PIN1AT given the list of configuration C{states} and initial
         temperatures C{dea_T0} and C{pin_T0}.
@@ -97,10 +540,16 @@ class TwoDOF(object):
         The states recarray must include the following columns::
           tstart  tstop  power  pitch  simpos
 
+        Model results for the ``cache_size`` most recently used parameter sets
+        are kept, along with the corresponding per-MSID temperatures at the
+        requested times.
+
         :param states: numpy recarray of states (must be contiguous)
         :param pin0: initial value (degC) of 1pin1at at states[0]['tstart']
         :param dea0: initial value (degC) of 1pdeaat at states[0]['tstart']
         :param dt: approximate time spacing for calculating model values (secs)
+        :param exact: evaluate the model exactly at the requested times (no dt grid)
+        :param cache_size: number of parameter sets to keep model results for
 
         :rtype: TwoDOF object
         """
@@ -108,12 +557,32 @@ class TwoDOF(object):
         self.T_pin0 = T_pin0
         self.T_dea0 = T_dea0
         self.dt = dt
+        self.exact = exact
         self.par = None
+        self.results = LRUCache(maxsize=cache_size)
+        self.msid_temps = LRUCache(maxsize=cache_size * 4)
 
     def interpolate_msid_temp(self, msid, t):
-        """Return predicted temperatures in degC for ``msid`` at times ``t``."""
-        out = self.predT[0,:] if msid == '1pin1at' else self.predT[1,:]
-        return Ska.Numpy.interpolate(out + KtoC, self.tval, t)
+        """Return predicted temperatures in degC for ``msid`` at times ``t``.
+        The returned array is cached so it is read-only."""
+        key = (self.par, msid, get_times_key(t))
+        out = self.msid_temps.get(key)
+        if out is not None:
+            return out
+
+        if self.exact:
+            t = np.clip(np.asarray(t, dtype=float),
+                        self.coeffs['tstart'][0], self.coeffs['tstop'][-1])
+            idx = get_state_index(self.coeffs['tstart'], t)
+            predT = eval_state_coeffs(self.coeffs, t, idx)
+            out = predT[0 if msid == '1pin1at' else 1] + KtoC
+        else:
+            out = self.predT[0,:] if msid == '1pin1at' else self.predT[1,:]
+            out = Ska.Numpy.interpolate(out + KtoC, self.tval, t)
+
+        out.flags.writeable = False
+        self.msid_temps.set(key, out)
+        return out
 
     def calc_model(self, t, par, msid='1pdeaat'):
         """
@@ -123,49 +592,29 @@ class TwoDOF(object):
 
         :rtype: array of temperatures for C{msid}
         """
-        # If params are unchanged then use existing values
-        if par == self.par:
-            return self.interpolate_msid_temp(msid, t)
-
-        predT = None
-        predTs = []
-        tvals = []
-        Ti = np.array([[self.T_pin0],
-                       [self.T_dea0]]) + CtoK
-
-        for state in self.states:
-            U01 = par['u01'] + par['u01quad'] * ((state['pitch']-110.)/60.)**2
-            U12 = par['u12']
-            C1 = par['c1']
-            C2 = par['c2']
-
-            M = np.array([[-(U01 + U12) / C1 ,  U12 / C1],
-                          [U12 / C2          , -U12 / C2]])
-            eigvals, eigvecs = np.linalg.eig(M)
-            eigvecinvs = np.linalg.inv(eigvecs)
-
-            t0 = state['tstart']
-
-            # Make array of times. 
-            n_t = int((state['tstop'] - state['tstart']) / self.dt)
-            tval = np.linspace(state['tstart'], state['tstop'], n_t+2)
-
-            # Calculated predicted temperatures for this state
-            predT = calc_state_temps(state, par, tval - t0, Ti,
-                                     eigvals, eigvecs, eigvecinvs,
-                                     U01, C1, C2)
-            tvals.append(tval)
-            predTs.append(predT)
-
-            Ti = predT[:, -1].reshape(2,1)
-
-        self.tval = np.hstack(tvals)
-        self.predT = np.hstack(predTs)
+        par = ModelPar.from_par(par)
+
+        # If params were used recently then use existing values
+        result = self.results.get(par)
+        if result is None:
+            Ti = np.array([[self.T_pin0],
+                           [self.T_dea0]]) + CtoK
+            if self.exact:
+                result = calc_state_coeffs(self.states, Ti, par)
+            else:
+                result = calc_model_grid(self.states, Ti, par, self.dt)
+            self.results.set(par, result)
+
+        if self.exact:
+            self.coeffs = result
+        else:
+            self.tval, self.predT = result
         self.par = par
         
         return self.interpolate_msid_temp(msid, t)
 
-def calc_twodof_model(states, T_pin0, T_dea0, times, par, dt=32.8):
+def calc_twodof_model(states, T_pin0, T_dea0, times, par, dt=32.8, exact=False,
+                      out_dtype=None):
     """Calculate the PSMC temperatures 1PDEAAT and 1PIN1AT given the list of
     configuration ``states`` and initial temperatures ``dea_T0`` and ``pin_T0``.
 
@@ -178,45 +627,580 @@ def calc_twodof_model(states, T_pin0, T_dea0, times, par, dt=32.8):
     :param times: array of times at which to return the model temperatures
     :param par: model parameters dictionary
     :param dt: approximate time spacing for calculating model values (secs)
+    :param exact: evaluate the model exactly at ``times`` instead of
+                  interpolating from a grid with spacing ``dt``
+    :param out_dtype: dtype of output arrays (e.g. 'f4' for compact output,
+                      default=None => float64).  Propagation is always float64.
 
     :rtype: predicted temperature arrays (T_pin, T_dea)
     """
-    predTs = []
-    tvals = []
     Ti = np.array([[T_pin0],
                    [T_dea0]]) + CtoK
 
-    for state in states:
-        U01 = par['u01'] +  par['u01quad'] * ((state['pitch']-110.)/60)**2
-        U12 = par['u12']
-        C1 = par['c1']
-        C2 = par['c2']
+    if exact:
+        predT = calc_model_exact(states, Ti, par, times)
+        T_pin = predT[0] + KtoC
+        T_dea = predT[1] + KtoC
+    else:
+        tval, predT = calc_model_grid(states, Ti, par, dt)
 
-        M = np.array([[-(U01 + U12) / C1 ,  U12 / C1],
-                      [U12 / C2          , -U12 / C2]])
-        eigvals, eigvecs = np.linalg.eig(M)
-        eigvecinvs = np.linalg.inv(eigvecs)
+        # Interpolate predicted temperatures in degC at desired output times
+        T_pin = Ska.Numpy.interpolate(predT[0,:] + KtoC, tval, times)
+        T_dea = Ska.Numpy.interpolate(predT[1,:] + KtoC, tval, times)
 
-        t0 = state['tstart']
+    if out_dtype is not None:
+        T_pin = T_pin.astype(out_dtype)
+        T_dea = T_dea.astype(out_dtype)
 
-        # Make array of times. 
-        n_t = int((state['tstop'] - state['tstart']) / dt)
-        tval = np.linspace(state['tstart'], state['tstop'], n_t+2)
+    return T_pin, T_dea
 
-        # Calculated predicted temperatures for this state
-        predT = calc_state_temps(state, par, tval - t0, Ti,
-                                 eigvals, eigvecs, eigvecinvs,
-                                 U01, C1, C2)
-        tvals.append(tval)
-        predTs.append(predT)
+def iter_twodof_model(states, T_pin0, T_dea0, par, dt=32.8, chunk_size=100000,
+                      tstart=None, tstop=None, out_dtype=None):
+    """Generate the PSMC temperatures 1PDEAAT and 1PIN1AT in chunks of at most
+    ``chunk_size`` samples at times ``tstart + n * dt`` (up to ``tstop``).
 
-        Ti = predT[:, -1].reshape(2,1)
+    Only the per-state solution coefficients are held in memory and each chunk
+    is evaluated exactly from the closed-form solution, so memory use does not
+    grow with the length of the run.  This allows multi-year model runs to be
+    streamed to disk, histogrammed or checked for violations on the fly.
 
-    tval = np.hstack(tvals)
-    predT = np.hstack(predTs)
+    :param states: iterable list of states (must be contiguous)
+    :param T_pin0: initial value (degC) of 1pin1at at states[0]['tstart']
+    :param T_dea0: initial value (degC) of 1pdeaat at states[0]['tstart']
+    :param par: model parameters dictionary
+    :param dt: time spacing of output values (secs)
+    :param chunk_size: maximum number of samples per chunk
+    :param tstart: start time of output (default=start of first state).
+                   Clipped to the span of ``states``.
+    :param tstop: stop time of output (default=stop of last state).
+                  Clipped to the span of ``states``.
+    :param out_dtype: dtype of output temperatures (default=None => float64)
+
+    :returns: generator of (times, T_pin, T_dea) chunks
+    """
+    Ti = np.array([[T_pin0],
+                   [T_dea0]]) + CtoK
+    coeffs = calc_state_coeffs(states, Ti, par)
+    # Clip the output range to the span of states (as for calc_model_exact)
+    tstart = coeffs['tstart'][0] if tstart is None else max(tstart, coeffs['tstart'][0])
+    tstop = coeffs['tstop'][-1] if tstop is None else min(tstop, coeffs['tstop'][-1])
+
+    n_times = int(np.ceil((tstop - tstart) / dt))
+    for i0 in range(0, n_times, chunk_size):
+        times = tstart + dt * np.arange(i0, min(i0 + chunk_size, n_times))
+        idx = get_state_index(coeffs['tstart'], times)
+        predT = eval_state_coeffs(coeffs, times, idx) + KtoC
+        if out_dtype is not None:
+            predT = predT.astype(out_dtype)
+        yield times, predT[0], predT[1]
 
-    # Interpolate predicted temperatures in degC at desired output times
-    T_pin = Ska.Numpy.interpolate(predT[0,:] + KtoC, tval, times)
-    T_dea = Ska.Numpy.interpolate(predT[1,:] + KtoC, tval, times)
+def calc_chunk_map(args):
+    """Process pool worker for ``calc_twodof_model_parallel()``: return the
+    composed affine map (A_tot, b_tot) for a chunk of states.
+
+    :param args: tuple of (states, par)
+    """
+    states, par = args
+    maps = get_state_maps(states, par)
+    return compose_state_maps(maps['A'], maps['b'])
+
+def calc_chunk_temps(args):
+    """Process pool worker for ``calc_twodof_model_parallel()``: return the
+    model temperatures (T_pin, T_dea) for a chunk of states.
+
+    :param args: tuple of (states, T_pin0, T_dea0, times, par, dt, exact)
+    """
+    states, T_pin0, T_dea0, times, par, dt, exact = args
+    return calc_twodof_model(states, T_pin0, T_dea0, times, par, dt=dt, exact=exact)
+
+def calc_twodof_model_parallel(states, T_pin0, T_dea0, times, par, dt=32.8, exact=False,
+                               n_chunk=None, pool=None, out_dtype=None):
+    """Calculate the PSMC temperatures as for ``calc_twodof_model()`` by
+    splitting ``states`` into ``n_chunk`` contiguous chunks that are evaluated
+    in parallel on a process pool.
+
+    Each state takes the node temperatures through an affine map so the
+    chunks first compose their state maps in parallel.  A short serial scan
+    over the chunk maps then gives the exact node temperatures at each chunk
+    boundary and finally the chunks are evaluated concurrently.  The result
+    is the same as the serial calculation apart from rounding.
+
+    :param states: iterable list of states (must be contiguous)
+    :param T_pin0: initial value (degC) of 1pin1at at states[0]['tstart']
+    :param T_dea0: initial value (degC) of 1pdeaat at states[0]['tstart']
+    :param times: sorted array of times at which to return the model temperatures
+    :param par: model parameters dictionary
+    :param dt: approximate time spacing for calculating model values (secs)
+    :param exact: evaluate the model exactly at ``times``
+    :param n_chunk: number of chunks (default=number of CPUs)
+    :param pool: multiprocessing.Pool to use (default=create a pool for this call)
+    :param out_dtype: dtype of output arrays (default=None => float64)
+
+    :rtype: predicted temperature arrays (T_pin, T_dea)
+    """
+    if n_chunk is None:
+        n_chunk = multiprocessing.cpu_count()
+    n_chunk = max(1, min(n_chunk, len(states)))
+    i_states = np.linspace(0, len(states), n_chunk + 1).astype(int)
+    chunk_states = [states[i0:i1] for i0, i1 in zip(i_states[:-1], i_states[1:])]
+
+    # Time samples at or after the start of each chunk go with that chunk
+    times = np.asarray(times)
+    tstarts = get_state_arrays(states)['tstart'][i_states[1:-1]]
+    i_times = np.concatenate([[0], np.searchsorted(times, tstarts), [len(times)]])
+
+    close_pool = pool is None
+    if close_pool:
+        pool = multiprocessing.Pool(n_chunk)
+    try:
+        maps = pool.map(calc_chunk_map, [(x, par) for x in chunk_states])
+
+        # Scan the chunk maps to get the node temperatures at each chunk start
+        T = np.array([T_pin0, T_dea0], dtype=float) + CtoK
+        T_starts = [T]
+        for A_tot, b_tot in maps[:-1]:
+            T = np.dot(A_tot, T) + b_tot
+            T_starts.append(T)
+
+        args = [(x, T[0] + KtoC, T[1] + KtoC, times[i0:i1], par, dt, exact)
+                for x, T, i0, i1 in zip(chunk_states, T_starts, i_times[:-1], i_times[1:])
+                if i1 > i0]
+        results = pool.map(calc_chunk_temps, args)
+    finally:
+        if close_pool:
+            pool.close()
+            pool.join()
+
+    T_pin = np.concatenate([np.zeros(0)] + [x[0] for x in results])
+    T_dea = np.concatenate([np.zeros(0)] + [x[1] for x in results])
+
+    if out_dtype is not None:
+        T_pin = T_pin.astype(out_dtype)
+        T_dea = T_dea.astype(out_dtype)
 
     return T_pin, T_dea
+
+def calc_decimation_mask(states, T_pin0, T_dea0, times, par, tol=0.01):
+    """Find the subset of output ``times`` needed to reproduce the model
+    temperatures to within ``tol`` (degC) by linear interpolation.
+
+    Within each state the node temperatures are a sum of decaying exponentials
+    (see ``calc_state_coeffs()``) so the curvature at time t bounds the
+    curvature over all later times in the same state::
+
+      |T''| <= sum_k |amps[n, k]| * (eigvals[k] / 1000)**2 * exp(eigvals[k] * (t - tstart) / 1000)
+
+    Linear interpolation over a step h starting at t is therefore accurate to
+    h**2 / 8 * |T''(t)|, which gives the longest allowed step from each kept
+    sample.  The samples on either side of each state transition are always
+    kept so sampling stays dense where the curve has a kink.
+
+    :param states: iterable list of states (must be contiguous)
+    :param T_pin0: initial value (degC) of 1pin1at at states[0]['tstart']
+    :param T_dea0: initial value (degC) of 1pdeaat at states[0]['tstart']
+    :param times: sorted array of output times
+    :param par: model parameters dictionary
+    :param tol: maximum interpolation error (degC)
+
+    :rtype: boolean mask for ``times``
+    """
+    times = np.asarray(times)
+    mask = np.zeros(len(times), dtype=bool)
+    if len(times) < 3:
+        mask[:] = True
+        return mask
+
+    Ti = np.array([[T_pin0],
+                   [T_dea0]]) + CtoK
+    coeffs = calc_state_coeffs(states, Ti, par)
+    idx = get_state_index(coeffs['tstart'], times)
+    dt_ksec = np.maximum(times - coeffs['tstart'].take(idx), 0.0) / 1000.
+
+    curv = np.zeros(len(times))
+    for node in (0, 1):
+        node_curv = np.zeros(len(times))
+        for k in (0, 1):
+            eigval = coeffs['eigvals'][:, k].take(idx)
+            node_curv += (np.abs(coeffs['amps'][:, node, k].take(idx))
+                          * (eigval / 1000.)**2 * np.exp(eigval * dt_ksec))
+        curv = np.maximum(curv, node_curv)
+
+    with np.errstate(divide='ignore'):
+        h_max = np.sqrt(8.0 * tol / curv)
+
+    # Index of the last sample in each state (kept along with the next sample)
+    i_last = np.flatnonzero(np.diff(idx))
+    mask[i_last] = True
+    mask[i_last + 1] = True
+    mask[0] = mask[-1] = True
+
+    i = 0
+    n_times = len(times)
+    while i < n_times - 1:
+        j = np.searchsorted(times, times[i] + h_max[i], side='right') - 1
+        i_break = np.searchsorted(i_last, i)
+        if i_break < len(i_last):
+            j = min(j, i_last[i_break])
+        i = min(max(j, i + 1), n_times - 1)
+        mask[i] = True
+
+    return mask
+
+def get_state_extrema(coeffs):
+    """Find the interior extremum (if any) of each node temperature within
+    each state.  Within a state the node temperature is
+    ``T_ss + a1 * exp(l1 * s) + a2 * exp(l2 * s)`` with ``s = (t - tstart) /
+    1000`` (see ``calc_state_coeffs()``) and its derivative is zero at most
+    once, where::
+
+      exp((l1 - l2) * s) = -(a2 * l2) / (a1 * l1)
+
+    :param coeffs: state coefficients from ``calc_state_coeffs()`` (single
+                   parameter set)
+
+    :rtype: t_ext[n_states, 2] (secs), T_ext[n_states, 2] (degK), both NaN
+            where the node temperature is monotonic within the state
+    """
+    l1 = coeffs['eigvals'][:, 0:1]
+    l2 = coeffs['eigvals'][:, 1:2]
+    a1 = coeffs['amps'][:, :, 0]
+    a2 = coeffs['amps'][:, :, 1]
+    dur = ((coeffs['tstop'] - coeffs['tstart']) / 1000.)[:, np.newaxis]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = -(a2 * l2) / (a1 * l1)
+        s_ext = np.log(ratio) / (l1 - l2)
+        ok = (ratio > 0) & (s_ext > 0) & (s_ext < dur)
+    s_ext = np.where(ok, s_ext, np.nan)
+
+    T_ext = coeffs['T_ss'] + a1 * np.exp(l1 * s_ext) + a2 * np.exp(l2 * s_ext)
+    t_ext = coeffs['tstart'][:, np.newaxis] + s_ext * 1000.
+
+    return t_ext, T_ext
+
+def get_state_stop_temps(coeffs):
+    """Return the node temperatures (degK) at the end of each state as an
+    [n_states, 2] array (single parameter set)."""
+    dur = ((coeffs['tstop'] - coeffs['tstart']) / 1000.)[:, np.newaxis, np.newaxis]
+    exps = np.exp(coeffs['eigvals'][:, np.newaxis, :] * dur)
+    return coeffs['T_ss'] + np.sum(coeffs['amps'] * exps, axis=-1)
+
+def calc_state_envelope(states, T_pin0, T_dea0, par):
+    """Calculate the minimum and maximum of 1PIN1AT and 1PDEAAT within each
+    state without sampling the model.  The node temperatures are monotonic
+    within a state apart from at most one interior extremum (see
+    ``get_state_extrema()``) so the range over a state is spanned by the
+    start, stop and extremum temperatures.  The cost is proportional to the
+    number of states, so this is suited to quick go / no-go screening of many
+    candidate schedules against a limit, e.g.::
+
+      env = calc_state_envelope(states, T_pin0, T_dea0, par)
+      ok = np.max(env['T_dea_max']) < T_dea_limit
+
+    :param states: iterable list of states (must be contiguous)
+    :param T_pin0: initial value (degC) of 1pin1at at states[0]['tstart']
+    :param T_dea0: initial value (degC) of 1pdeaat at states[0]['tstart']
+    :param par: model parameters dictionary
+
+    :rtype: recarray with columns tstart, tstop, T_pin_min, T_pin_max,
+            T_dea_min and T_dea_max (degC), one row per state
+    """
+    coeffs = calc_state_coeffs(states, np.array([T_pin0, T_dea0]) + CtoK, par)
+    T_start = coeffs['T_start']
+    T_stop = np.vstack([T_start[1:], get_state_stop_temps(coeffs)[-1:]])
+    t_ext, T_ext = get_state_extrema(coeffs)
+
+    # fmin / fmax ignore the NaN extremum of monotonic states
+    T_min = np.fmin(np.minimum(T_start, T_stop), T_ext) + KtoC
+    T_max = np.fmax(np.maximum(T_start, T_stop), T_ext) + KtoC
+
+    return np.rec.fromarrays([coeffs['tstart'], coeffs['tstop'],
+                              T_min[:, 0], T_max[:, 0], T_min[:, 1], T_max[:, 1]],
+                             names=['tstart', 'tstop', 'T_pin_min', 'T_pin_max',
+                                    'T_dea_min', 'T_dea_max'])
+
+def calc_limit_intervals(states, T_pin0, T_dea0, par, limits, msid='1pdeaat', tol=1e-3):
+    """Find the exact time intervals where the ``msid`` temperature is at or
+    above each of ``limits`` (degC), along with the maximum temperature in
+    each interval.
+
+    Each state is split at the interior extremum of the node temperature (see
+    ``get_state_extrema()``) into at most two pieces on which the temperature
+    is monotonic.  A piece contains a crossing of a limit if and only if its
+    end temperatures are on either side of the limit, so all crossings of all
+    limits are bracketed in one vectorized pass.  The brackets are then
+    refined together by bisection on the closed-form solution until they are
+    shorter than ``tol``.  Interval boundaries are the outer ends of the
+    final brackets so each interval covers all times at or above its limit.
+
+    The maximum in each interval is the largest of the piece boundary and
+    interior extremum temperatures within it (or the limit itself).
+
+    :param states: iterable list of states (must be contiguous)
+    :param T_pin0: initial value (degC) of 1pin1at at states[0]['tstart']
+    :param T_dea0: initial value (degC) of 1pdeaat at states[0]['tstart']
+    :param par: model parameters dictionary
+    :param limits: list of limits (degC)
+    :param msid: MSID to check ('1pin1at' or '1pdeaat')
+    :param tol: accuracy of interval start and stop times (secs)
+
+    :rtype: list of recarrays with columns tstart, tstop, maxtemp (degC) and
+            tmax (time of maxtemp), one for each of ``limits``
+    """
+    node = 0 if msid == '1pin1at' else 1
+    coeffs = calc_state_coeffs(states, np.array([T_pin0, T_dea0]) + CtoK, par)
+    tstart = coeffs['tstart']
+    tstop = coeffs['tstop']
+    t_ext, T_ext = get_state_extrema(coeffs)
+    t_ext = t_ext[:, node]
+    T_ext = T_ext[:, node]
+    T_start = coeffs['T_start'][:, node]
+    # Use the propagated start temperature of the next state as the stop
+    # temperature so the pieces join exactly at state boundaries.
+    T_stop = np.append(T_start[1:], get_state_stop_temps(coeffs)[-1, node])
+
+    # Monotonic pieces: state start to extremum (or stop), extremum to stop
+    has_ext = ~np.isnan(t_ext)
+    i_ext = np.flatnonzero(has_ext)
+    idx = np.concatenate([np.arange(len(tstart)), i_ext])
+    t0 = np.concatenate([tstart, t_ext[i_ext]])
+    t1 = np.concatenate([np.where(has_ext, t_ext, tstop), tstop[i_ext]])
+    T0 = np.concatenate([T_start, T_ext[i_ext]])
+    T1 = np.concatenate([np.where(has_ext, T_ext, T_stop), T_stop[i_ext]])
+    order = np.argsort(t0, kind='mergesort')
+    idx, t0, t1, T0, T1 = [x[order] for x in (idx, t0, t1, T0, T1)]
+
+    # Bracket the crossings of every limit
+    limits_K = np.asarray(limits, dtype=float) + CtoK
+    above0 = T0[:, np.newaxis] >= limits_K
+    above1 = T1[:, np.newaxis] >= limits_K
+    i_piece, i_limit = np.nonzero(above0 != above1)
+    rising = above1[i_piece, i_limit]
+    lo = t0[i_piece]
+    hi = t1[i_piece]
+
+    # Refine all brackets at once by bisection
+    i_state = idx[i_piece]
+    T_ss = coeffs['T_ss'][i_state, node]
+    amps = coeffs['amps'][i_state, node, :]
+    eigvals = coeffs['eigvals'][i_state, :]
+    cross_limits = limits_K[i_limit]
+    t_ref = tstart[i_state]
+    n_iter = int(np.ceil(np.log2(max(np.max(hi - lo), tol) / tol))) if len(lo) else 0
+    for i in range(n_iter):
+        mid = (lo + hi) / 2.
+        s = (mid - t_ref) / 1000.
+        T_mid = (T_ss + amps[:, 0] * np.exp(eigvals[:, 0] * s)
+                 + amps[:, 1] * np.exp(eigvals[:, 1] * s))
+        move_hi = (T_mid >= cross_limits) == rising
+        hi = np.where(move_hi, mid, hi)
+        lo = np.where(move_hi, lo, mid)
+    t_cross = np.where(rising, lo, hi)
+
+    # Candidate maximum points: start of every piece and the end of the last
+    cand_t = np.append(t0, tstop[-1])
+    cand_T = np.append(T0, T_stop[-1])
+
+    out = []
+    for j, limit in enumerate(limits_K):
+        ok = i_limit == j
+        cross_order = np.argsort(t_cross[ok], kind='mergesort')
+        events = zip(t_cross[ok][cross_order].tolist(), rising[ok][cross_order].tolist())
+
+        intervals = []
+        above = T_start[0] >= limit
+        t_up = tstart[0]
+        for t, up in events:
+            if up and not above:
+                t_up = t
+            elif above and not up:
+                intervals.append((t_up, t))
+            above = up
+        if above:
+            intervals.append((t_up, tstop[-1]))
+
+        rows = []
+        for t_up, t_down in intervals:
+            i0 = np.searchsorted(cand_t, t_up, side='left')
+            i1 = np.searchsorted(cand_t, t_down, side='right')
+            maxtemp, tmax = limit, t_up
+            if i1 > i0:
+                i_max = i0 + np.argmax(cand_T[i0:i1])
+                if cand_T[i_max] > maxtemp:
+                    maxtemp, tmax = cand_T[i_max], cand_t[i_max]
+            rows.append((t_up, t_down, maxtemp + KtoC, tmax))
+        cols = np.array(rows, dtype=float).reshape(-1, 4).T
+        out.append(np.rec.fromarrays(cols, names=['tstart', 'tstop', 'maxtemp', 'tmax']))
+
+    return out
+
+def get_batch_par(pars):
+    """Convert an (N, len(PARNAMES)) array of N parameter sets (columns in
+    ``PARNAMES`` order) to a model parameters dictionary with (N, 1) array
+    values that broadcast against per-state arrays.
+
+    :param pars: array of parameter sets
+    :rtype: model parameters dictionary
+    """
+    pars = np.atleast_2d(pars)
+    if pars.shape[1] != len(PARNAMES):
+        raise ValueError('Parameter sets must have %d columns (%s)'
+                         % (len(PARNAMES), ' '.join(PARNAMES)))
+    return dict((name, pars[:, i:i+1]) for i, name in enumerate(PARNAMES))
+
+def interpolate_grid(y, xin, xout):
+    """Linearly interpolate ``y`` (last axis corresponds to sorted ``xin``) at
+    ``xout``, clipping ``xout`` to the range of ``xin``.  The interpolation
+    indexes and weights are computed once and applied to all leading axes of
+    ``y``.
+    """
+    xout = np.clip(xout, xin[0], xin[-1])
+    i1 = np.clip(np.searchsorted(xin, xout, side='right'), 1, len(xin) - 1)
+    i0 = i1 - 1
+    dx = xin[i1] - xin[i0]
+    w = np.where(dx > 0, (xout - xin[i0]) / np.where(dx > 0, dx, 1.0), 0.0)
+
+    return y.take(i0, axis=-1) * (1 - w) + y.take(i1, axis=-1) * w
+
+def calc_twodof_model_batch(states, T_pin0, T_dea0, times, pars, dt=32.8, exact=False,
+                            out_dtype=None):
+    """Calculate the PSMC temperatures 1PDEAAT and 1PIN1AT for N parameter
+    sets at once.  The work that depends only on the state schedule (time grid,
+    state indexing, detector masks and pitch interpolation weights) is shared
+    by all parameter sets.
+
+    :param states: iterable list of states (must be contiguous)
+    :param T_pin0: initial value (degC) of 1pin1at at states[0]['tstart'] (scalar or N values)
+    :param T_dea0: initial value (degC) of 1pdeaat at states[0]['tstart'] (scalar or N values)
+    :param times: array of times at which to return the model temperatures
+    :param pars: (N, len(PARNAMES)) array of parameter sets in ``PARNAMES`` order
+    :param dt: approximate time spacing for calculating model values (secs)
+    :param exact: evaluate the model exactly at ``times`` instead of
+                  interpolating from a grid with spacing ``dt``
+    :param out_dtype: dtype of output arrays (default=None => float64)
+
+    :rtype: predicted temperature arrays (T_pin, T_dea), each (N, len(times))
+    """
+    par = get_batch_par(pars)
+    n_par = len(par['u01'])
+    Ti = np.empty((n_par, 2))
+    Ti[:, 0] = np.asarray(T_pin0, dtype=float).reshape(-1) + CtoK
+    Ti[:, 1] = np.asarray(T_dea0, dtype=float).reshape(-1) + CtoK
+
+    coeffs = calc_state_coeffs(states, Ti, par)
+    times = np.asarray(times, dtype=float)
+
+    if exact:
+        times = np.clip(times, coeffs['tstart'][0], coeffs['tstop'][-1])
+        idx = get_state_index(coeffs['tstart'], times)
+        predT = eval_state_coeffs(coeffs, times, idx)
+    else:
+        tval, idx = get_grid(coeffs['tstart'], coeffs['tstop'], dt)
+        predT = interpolate_grid(eval_state_coeffs(coeffs, tval, idx), tval, times)
+
+    predT = predT + KtoC
+    if out_dtype is not None:
+        predT = predT.astype(out_dtype)
+
+    return predT[0], predT[1]
+
+def calc_twodof_jacobian(states, T_pin0, T_dea0, times, par, dt=32.8, exact=False,
+                         parnames=None):
+    """Calculate the PSMC temperatures 1PDEAAT and 1PIN1AT along with their
+    derivatives with respect to each of the model parameters ``parnames``.
+
+    The model is analytic in the parameters, so the derivatives are computed
+    with the complex-step method: one parameter set per parameter in
+    ``parnames``, each with an imaginary perturbation of that parameter, is
+    propagated together with ``calc_twodof_model_batch()`` and the derivative
+    is the imaginary part of the result divided by the step.  This is
+    accurate to machine precision (no subtractive cancellation as for finite
+    differences).
+
+    :param states: iterable list of states (must be contiguous)
+    :param T_pin0: initial value (degC) of 1pin1at at states[0]['tstart']
+    :param T_dea0: initial value (degC) of 1pdeaat at states[0]['tstart']
+    :param times: array of times at which to return the model temperatures
+    :param par: model parameters dictionary
+    :param dt: approximate time spacing for calculating model values (secs)
+    :param exact: evaluate the model exactly at ``times`` instead of
+                  interpolating from a grid with spacing ``dt``
+    :param parnames: parameters for the derivatives (default=``PARNAMES``)
+
+    :rtype: T_pin, T_dea, J_pin[len(times), len(parnames)], J_dea[len(times), len(parnames)]
+    """
+    if parnames is None:
+        parnames = PARNAMES
+    step = 1e-20
+    n_deriv = len(parnames)
+    pars = np.array([[par[name] for name in PARNAMES]] * n_deriv, dtype=complex)
+    pars[np.arange(n_deriv), [PARNAMES.index(x) for x in parnames]] += 1j * step
+
+    T_pins, T_deas = calc_twodof_model_batch(states, T_pin0, T_dea0, times, pars,
+                                             dt=dt, exact=exact)
+
+    return (T_pins[0].real, T_deas[0].real,
+            T_pins.imag.transpose() / step, T_deas.imag.transpose() / step)
+
+def par_hash(par):
+    """Return a hash string identifying the model parameters ``par`` and the
+    ``characteristics.VERSION``.  A checkpoint is only valid for the same hash.
+    """
+    vals = ','.join('%s=%r' % (name, float(par[name])) for name in PARNAMES)
+    text = 'VERSION=%s:%s' % (characteristics.VERSION, vals)
+    return hashlib.md5(text.encode('ascii')).hexdigest()
+
+def calc_checkpoint(states, T_pin0, T_dea0, par, time=None):
+    """Calculate a model checkpoint (node temperatures at a state boundary)
+    from which the model can later be resumed with ``calc_twodof_model``
+    using the states that start at or after the checkpoint time.
+
+    The checkpoint is at the start of the state containing ``time``, or the
+    start of the last state if ``time`` is None.
+
+    :param states: iterable list of states (must be contiguous)
+    :param T_pin0: initial value (degC) of 1pin1at at states[0]['tstart']
+    :param T_dea0: initial value (degC) of 1pdeaat at states[0]['tstart']
+    :param par: model parameters dictionary
+    :param time: time (secs) at or before which to make the checkpoint
+
+    :rtype: dict with time, T_pin, T_dea, par_hash and version
+    """
+    Ti = np.array([[T_pin0],
+                   [T_dea0]]) + CtoK
+    coeffs = calc_state_coeffs(states, Ti, par)
+    tstart = coeffs['tstart']
+    i = len(tstart) - 1 if time is None else int(get_state_index(tstart, time))
+
+    return dict(time=float(tstart[i]),
+                T_pin=float(coeffs['T_start'][i, 0] + KtoC),
+                T_dea=float(coeffs['T_start'][i, 1] + KtoC),
+                par_hash=par_hash(par),
+                version=characteristics.VERSION)
+
+def write_checkpoint(filename, checkpoint):
+    """Write ``checkpoint`` to ``filename`` (JSON).  The file is written to a
+    temporary file and renamed so readers never see a partial checkpoint."""
+    dirname = os.path.dirname(os.path.abspath(filename))
+    fd, tmpname = tempfile.mkstemp(dir=dirname, suffix='.tmp')
+    f = os.fdopen(fd, 'w')
+    json.dump(checkpoint, f, indent=1, sort_keys=True)
+    f.close()
+    os.rename(tmpname, filename)
+
+def read_checkpoint(filename, par):
+    """Read a model checkpoint from ``filename``.  Return None if the file does
+    not exist or if the checkpoint was made with different model parameters
+    or characteristics version than ``par`` and ``characteristics.VERSION``.
+
+    :param filename: checkpoint file name
+    :param par: model parameters dictionary
+
+    :rtype: checkpoint dict or None
+    """
+    if not os.path.exists(filename):
+        return None
+    checkpoint = json.load(open(filename))
+    if checkpoint.get('par_hash') != par_hash(par):
+        return None
+    return checkpoint